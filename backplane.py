@@ -0,0 +1,414 @@
+import asyncio
+import json
+import os
+import secrets
+import sys
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+
+# ====== Общая шина между воркерами ======
+# Через бэкплейн идут широковещательные сообщения (звёзды, публичный чат),
+# адресные сообщения пользователям сайта и общее состояние (пары, очередь,
+# кто на каком узле онлайн). Реализации:
+#   memory://                — всё в этом процессе (один воркер, как раньше)
+#   unix:///tmp/stars.sock   — брокер на локальном сокете (несколько воркеров на машине)
+#   tcp://host:7700          — тот же брокер по сети (несколько машин)
+# Брокер запускается отдельно: python backplane.py serve unix:///tmp/stars.sock
+
+BACKPLANE_URL = os.environ.get("BACKPLANE_URL", "memory://")
+BACKPLANE_RECONNECT_DELAY = float(os.environ.get("BACKPLANE_RECONNECT_DELAY", "1"))
+# подписчик, у которого в буфере брокера скопилось больше, отключается:
+# медленный узел не должен раздувать память брокера
+BROKER_MAX_BUFFER = int(os.environ.get("BROKER_MAX_BUFFER", str(8 * 1024 * 1024)))
+
+Handler = Callable[[dict], Awaitable[None]]
+
+
+class Backplane(ABC):
+    # True — шину видят и другие процессы
+    shared = True
+
+    def __init__(self):
+        # у каждого процесса свой id, чтобы отличать свои сообщения от чужих
+        self.node_id = secrets.token_hex(6)
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    def subscribe(self, channel: str, handler: Handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def _dispatch(self, channel: str, message: dict):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                await handler(message)
+            except Exception as e:
+                print(f"DEBUG backplane handler error ({channel}):", e)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, channel: str, message: dict):
+        ...
+
+    # общее состояние: значение None означает «ключа нет»,
+    # ttl — через сколько секунд ключ исчезнет сам
+    @abstractmethod
+    async def get(self, key: str) -> Any:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def pop(self, key: str) -> Any:
+        ...
+
+    @abstractmethod
+    async def cas(self, key: str, expected: Any, value: Any) -> bool:
+        ...
+
+
+class KVStore:
+    # Словарь общего состояния с необязательным сроком жизни ключей.
+    # Одна и та же семантика для памяти процесса и для брокера.
+    # Просроченные ключи удаляются при обращении и раз в SWEEP_EVERY записей.
+
+    SWEEP_EVERY = 1024
+
+    def __init__(self):
+        self._data: Dict[str, Any] = {}
+        self._deadlines: Dict[str, float] = {}
+        self._writes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _get(self, key: str, now: float) -> Any:
+        deadline = self._deadlines.get(key)
+        if deadline is not None and deadline <= now:
+            self._data.pop(key, None)
+            del self._deadlines[key]
+            return None
+        return self._data.get(key)
+
+    def _put(self, key: str, value: Any, ttl: Optional[float], now: float):
+        self._deadlines.pop(key, None)
+        if value is None:
+            self._data.pop(key, None)
+            return
+        self._data[key] = value
+        if ttl is not None:
+            self._deadlines[key] = now + ttl
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            self.sweep(now)
+
+    def sweep(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        for key in [k for k, deadline in self._deadlines.items() if deadline <= now]:
+            self._data.pop(key, None)
+            del self._deadlines[key]
+
+    def apply(self, op: str, key: str, value=None, expected=None, ttl: Optional[float] = None):
+        now = time.monotonic()
+        if op == "get":
+            return self._get(key, now)
+        if op == "set":
+            self._put(key, value, ttl, now)
+            return None
+        if op == "pop":
+            current = self._get(key, now)
+            self._put(key, None, None, now)
+            return current
+        if op == "cas":
+            if self._get(key, now) != expected:
+                return False
+            self._put(key, value, None, now)
+            return True
+        raise ValueError(f"unknown op {op}")
+
+
+class MemoryBackplane(Backplane):
+    # видна только этому процессу
+    shared = False
+
+    def __init__(self):
+        super().__init__()
+        self._store = KVStore()
+
+    async def publish(self, channel: str, message: dict):
+        await self._dispatch(channel, message)
+
+    async def get(self, key: str) -> Any:
+        return self._store.apply("get", key)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self._store.apply("set", key, value, ttl=ttl)
+
+    async def pop(self, key: str) -> Any:
+        return self._store.apply("pop", key)
+
+    async def cas(self, key: str, expected: Any, value: Any) -> bool:
+        return self._store.apply("cas", key, value, expected)
+
+
+def _parse_address(url: str) -> Tuple[str, Any]:
+    parsed = urlparse(url)
+    if parsed.scheme == "unix":
+        return "unix", parsed.path
+    if parsed.scheme == "tcp":
+        return "tcp", (parsed.hostname or "127.0.0.1", parsed.port or 7700)
+    raise ValueError(f"unsupported backplane url: {url}")
+
+
+async def _open_connection(url: str):
+    kind, addr = _parse_address(url)
+    if kind == "unix":
+        return await asyncio.open_unix_connection(addr)
+    return await asyncio.open_connection(*addr)
+
+
+class BrokerBackplane(Backplane):
+    # Клиент брокера: JSON-строки в обе стороны. Публикации брокер рассылает
+    # всем подписчикам канала, включая отправителя, поэтому порядок сообщений
+    # одинаковый на всех узлах.
+
+    def __init__(self, url: str):
+        super().__init__()
+        self.url = url
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        # обработчики крутятся в отдельной задаче: читатель должен успевать
+        # разбирать ответы брокера, даже если обработчик сам ждёт get/cas
+        self._inbox: asyncio.Queue = asyncio.Queue()
+        self._dispatch_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._connect_lock = asyncio.Lock()
+        self._closed = False
+        # фоновые задачи (переподключение, досылка sub): держим ссылки до завершения
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print("DEBUG backplane task error:", task.exception())
+
+    async def start(self):
+        await self._ensure_connected()
+
+    async def _ensure_connected(self):
+        if self._writer is not None:
+            return
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            reader, writer = await _open_connection(self.url)
+            self._reader, self._writer = reader, writer
+            for channel in self._handlers:
+                await self._send({"op": "sub", "channel": channel})
+            self._reader_task = asyncio.create_task(self._read_loop(reader))
+            if self._dispatch_task is None:
+                self._dispatch_task = asyncio.create_task(self._dispatch_loop())
+
+    def subscribe(self, channel: str, handler: Handler):
+        new_channel = channel not in self._handlers
+        super().subscribe(channel, handler)
+        # без соединения подписку отправит _ensure_connected при переподключении
+        if new_channel and self._writer is not None:
+            self._spawn(self._send({"op": "sub", "channel": channel}))
+
+    async def _send(self, frame: dict):
+        if self._writer is None:
+            raise ConnectionError("backplane is not connected")
+        self._writer.write(json.dumps(frame, separators=(",", ":"), ensure_ascii=False).encode() + b"\n")
+        await self._writer.drain()
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = json.loads(line)
+                if frame.get("op") == "msg":
+                    self._inbox.put_nowait((frame["channel"], frame["msg"]))
+                elif frame.get("op") == "reply":
+                    fut = self._pending.pop(frame["id"], None)
+                    if fut and not fut.done():
+                        if "error" in frame:
+                            fut.set_exception(RuntimeError(f"backplane error: {frame['error']}"))
+                        else:
+                            fut.set_result(frame.get("value"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("DEBUG backplane read error:", e)
+        self._drop_connection()
+        if not self._closed:
+            self._spawn(self._reconnect())
+
+    async def _dispatch_loop(self):
+        while True:
+            channel, message = await self._inbox.get()
+            await self._dispatch(channel, message)
+
+    def _drop_connection(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError("backplane connection lost"))
+
+    async def _reconnect(self):
+        while not self._closed:
+            await asyncio.sleep(BACKPLANE_RECONNECT_DELAY)
+            try:
+                await self._ensure_connected()
+                print("Backplane reconnected")
+                return
+            except OSError as e:
+                print("DEBUG backplane reconnect failed:", e)
+
+    async def close(self):
+        self._closed = True
+        for task in (self._reader_task, self._dispatch_task, *self._tasks):
+            if task:
+                task.cancel()
+        self._drop_connection()
+
+    async def _request(self, op: str, **fields) -> Any:
+        await self._ensure_connected()
+        self._next_id += 1
+        req_id = self._next_id
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = fut
+        await self._send({"op": op, "id": req_id, **fields})
+        return await fut
+
+    async def publish(self, channel: str, message: dict):
+        await self._ensure_connected()
+        await self._send({"op": "pub", "channel": channel, "msg": message})
+
+    async def get(self, key: str) -> Any:
+        return await self._request("get", key=key)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        await self._request("set", key=key, value=value, ttl=ttl)
+
+    async def pop(self, key: str) -> Any:
+        return await self._request("pop", key=key)
+
+    async def cas(self, key: str, expected: Any, value: Any) -> bool:
+        return await self._request("cas", key=key, expected=expected, value=value)
+
+
+def create_backplane(url: str = BACKPLANE_URL) -> Backplane:
+    if url.startswith("memory:"):
+        return MemoryBackplane()
+    _parse_address(url)
+    return BrokerBackplane(url)
+
+
+# ====== Брокер ======
+
+class Broker:
+    def __init__(self):
+        self.store = KVStore()
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    frame = json.loads(line)
+                except ValueError as e:
+                    print("DEBUG broker bad frame:", e)
+                    continue
+                if not isinstance(frame, dict):
+                    continue
+                self._handle_frame(frame, writer)
+                # отправитель ждёт, пока брокер не отдаст ему ответы
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for subs in self.subscribers.values():
+                subs.discard(writer)
+            writer.close()
+
+    def _handle_frame(self, frame: dict, writer: asyncio.StreamWriter):
+        op = frame.get("op")
+        try:
+            if op == "sub":
+                self.subscribers.setdefault(frame["channel"], set()).add(writer)
+                return
+            if op == "pub":
+                data = json.dumps(
+                    {"op": "msg", "channel": frame["channel"], "msg": frame["msg"]},
+                    separators=(",", ":"),
+                    ensure_ascii=False,
+                ).encode() + b"\n"
+                for sub in list(self.subscribers.get(frame["channel"], ())):
+                    self._write(sub, data)
+                return
+            value = self.store.apply(op, frame["key"], frame.get("value"), frame.get("expected"), frame.get("ttl"))
+            reply = {"op": "reply", "id": frame["id"], "value": value}
+        except Exception as e:
+            print("DEBUG broker bad frame:", e)
+            if "id" not in frame:
+                return
+            # клиент ждёт ответа на запрос — не оставляем его висеть
+            reply = {"op": "reply", "id": frame["id"], "error": str(e) or type(e).__name__}
+        self._write(writer, json.dumps(reply).encode() + b"\n")
+
+    def _write(self, writer: asyncio.StreamWriter, data: bytes):
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > BROKER_MAX_BUFFER:
+            # не успевает читать: отключаем, узел переподключится и подпишется заново
+            print("DEBUG broker dropping slow client")
+            for subs in self.subscribers.values():
+                subs.discard(writer)
+            writer.close()
+            return
+        writer.write(data)
+
+
+async def serve_broker(url: str):
+    broker = Broker()
+    kind, addr = _parse_address(url)
+    if kind == "unix":
+        if os.path.exists(addr):
+            os.unlink(addr)
+        server = await asyncio.start_unix_server(broker.handle, addr)
+    else:
+        server = await asyncio.start_server(broker.handle, *addr)
+    print("Backplane broker listening on", url)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "serve":
+        asyncio.run(serve_broker(sys.argv[2] if len(sys.argv) > 2 else BACKPLANE_URL))
+    else:
+        print("usage: python backplane.py serve unix:///tmp/stars.sock")
@@ -0,0 +1,126 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+class RecentMessages:
+    # Кольцевой буфер последних сообщений публичного чата, по возрастанию id.
+    # Пока буфер держит нужный отрезок истории, страницы отдаются из памяти;
+    # за более старыми сообщениями идём в БД.
+
+    def __init__(self, size: int):
+        self.size = size
+        self.items: deque = deque(maxlen=size)
+        self.loaded = False
+        # в БД нет сообщений старше самого старого в буфере
+        self.complete = False
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, msg: Dict):
+        if self.items and msg["id"] <= self.items[-1]["id"]:
+            # с другого узла сообщение может прийти чуть позже соседнего
+            self.load_rows([msg], complete=self.complete)
+            return
+        if len(self.items) == self.size:
+            # самое старое сообщение вытесняется — теперь оно есть только в БД
+            self.complete = False
+        self.items.append(msg)
+
+    def load_rows(self, rows: List[Dict], complete: bool = False):
+        # rows в любом порядке; уже лежащие в буфере сообщения свежее, их не трогаем
+        merged = {m["id"]: m for m in rows}
+        merged.update((m["id"], m) for m in self.items)
+        ordered = sorted(merged.values(), key=lambda m: m["id"])
+        self.items = deque(ordered[-self.size:], maxlen=self.size)
+        self.complete = complete and len(ordered) <= self.size
+        self.loaded = True
+
+    def page(
+        self,
+        limit: int,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+    ) -> Optional[List[Dict]]:
+        # Страница от новых к старым или None, если буфер её не покрывает.
+        if not self.loaded:
+            return None
+        items = self.items
+        oldest = items[0]["id"] if items else None
+
+        if after is not None:
+            if not self.complete and (oldest is None or after < oldest - 1):
+                return None
+            newer = [m for m in items if m["id"] > after]
+            # ближайшие к курсору limit сообщений
+            return list(reversed(newer[:limit]))
+
+        older = [m for m in items if before is None or m["id"] < before]
+        if len(older) < limit and not self.complete:
+            return None
+        return list(reversed(older[-limit:]))
+
+
+class ChatJournal:
+    # Журнал публичных сообщений, ещё не записанных в БД. Сообщение сначала
+    # уходит в чат, а в chat_messages его дописывает фоновый писатель пачками
+    # до batch_size строк — по таймеру interval или как только набралась пачка.
+    # interval <= 0 — писать сразу (всё, что накопилось за время прошлой записи),
+    # неудачную запись тогда повторяем раз в секунду.
+
+    def __init__(
+        self,
+        max_size: int,
+        batch_size: int,
+        interval: float,
+        write: Callable[[List[Dict]], Awaitable[List[int]]],
+        on_saved: Optional[Callable[[List[Dict]], Awaitable[None]]] = None,
+    ):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self._write = write
+        self._on_saved = on_saved
+        self._rows: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def append(self, row: Dict) -> bool:
+        # False — журнал переполнен (БД не успевает), сообщение не принято
+        if len(self._rows) >= self.max_size:
+            return False
+        self._rows.append(row)
+        if self.interval <= 0 or len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval if self.interval > 0 else 1.0)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._rows:
+                batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+                try:
+                    ids = await self._write(batch)
+                except Exception as e:
+                    print("DEBUG chat journal flush error:", e)
+                    # возвращаем пачку в начало журнала, попробуем в следующий раз
+                    self._rows.extendleft(reversed(batch))
+                    return
+                if self._on_saved and ids:
+                    saved = [{**row, "id": row_id} for row, row_id in zip(batch, ids)]
+                    try:
+                        await self._on_saved(saved)
+                    except Exception as e:
+                        print("DEBUG chat journal on_saved error:", e)
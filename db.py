@@ -1,6 +1,11 @@
 import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector.errors import PoolError
 from typing import List, Dict, Optional
 import json
 
@@ -14,207 +19,432 @@ DB_CONFIG = {
 }
 
 
+# размер пула, сколько ждать свободное соединение (сек) и как часто проверять простаивающие
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_PING_INTERVAL = float(os.environ.get("DB_POOL_PING_INTERVAL", "30"))
+
+# Горячие запросы идут подготовленными (server-side prepared statements): MySQL
+# разбирает и планирует их один раз на соединение. Цена — лишний COM_STMT_RESET
+# на каждый вызов в коннекторе, поэтому при медленной сети до БД можно выключить.
+DB_USE_PREPARED = os.environ.get("DB_USE_PREPARED", "1") == "1"
+# сколько подготовленных запросов держим на одно соединение
+DB_PREPARED_CACHE = int(os.environ.get("DB_PREPARED_CACHE", "32"))
+# по сколько строк читают потоковые выборки
+DB_STREAM_CHUNK = int(os.environ.get("DB_STREAM_CHUNK", "1000"))
+
+
+# ====== ПУЛ СОЕДИНЕНИЙ ======
+
+class PooledConnection:
+    # Обёртка над соединением из пула: close() не рвёт TCP, а возвращает соединение в пул.
+
+    def __init__(self, pool: "ConnectionPool", conn):
+        self._pool = pool
+        self._conn = conn
+        self._cursors = []
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def prepared(self, sql: str, dictionary: bool = True):
+        # Курсор под запрос sql. Подготовленный курсор живёт вместе с физическим
+        # соединением и переживает возврат в пул: повторный execute того же sql
+        # (тот же объект строки — держите запрос в константе) идёт без PREPARE.
+        # Закрывать его не нужно; результат нужно дочитать (fetchall).
+        if not DB_USE_PREPARED:
+            cur = self._conn.cursor(dictionary=dictionary)
+            self._cursors.append(cur)
+            return cur
+
+        cache = getattr(self._conn, "_prepared_cursors", None)
+        if cache is None:
+            cache = OrderedDict()
+            self._conn._prepared_cursors = cache
+
+        key = (sql, dictionary)
+        cur = cache.get(key)
+        if cur is not None:
+            cache.move_to_end(key)
+            return cur
+
+        cur = self._conn.cursor(prepared=True, dictionary=dictionary)
+        cache[key] = cur
+        if len(cache) > DB_PREPARED_CACHE:
+            _, old = cache.popitem(last=False)
+            try:
+                old.close()
+            except Exception:
+                pass
+        return cur
+
+    def close(self):
+        cursors, self._cursors = self._cursors, []
+        for cur in cursors:
+            try:
+                cur.close()
+            except Exception:
+                pass
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+
+class ConnectionPool:
+    def __init__(self, config: Dict, size: int, timeout: float, ping_interval: float):
+        self.config = config
+        self.size = max(size, 1)
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, last_used), LIFO — переиспользуем самые «тёплые»
+        self._created = 0
+        self._stats = {
+            "acquired": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "connects": 0,
+            "reconnects": 0,
+            "discarded": 0,
+        }
 
-def get_connection():
-    return mysql.connector.connect(**DB_CONFIG)
+    def _connect(self):
+        conn = mysql.connector.connect(**self.config)
+        with self._cond:
+            self._stats["connects"] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _check(self, conn):
+        # Соединение долго лежало без дела: сервер мог закрыть сокет (wait_timeout)
+        try:
+            if conn.is_connected():
+                return conn
+        except Exception:
+            pass
+        self._discard(conn)
+        with self._cond:
+            self._stats["reconnects"] += 1
+        return self._connect()
+
+    def acquire(self) -> PooledConnection:
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolError(
+                        f"No free DB connection after {self.timeout}s (pool size {self.size})"
+                    )
+                waited = True
+                self._cond.wait(remaining)
+
+            wait_time = time.monotonic() - started
+            self._stats["acquired"] += 1
+            if waited:
+                self._stats["waits"] += 1
+            self._stats["wait_time_total"] += wait_time
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.monotonic() - last_used > self.ping_interval:
+                conn = self._check(conn)
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        healthy = True
+        try:
+            # Закрываем открытую транзакцию (в т.ч. неявную после SELECT),
+            # чтобы следующий пользователь не читал устаревший снапшот.
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            healthy = False
+
+        with self._cond:
+            if healthy:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._created -= 1
+                self._stats["discarded"] += 1
+            self._cond.notify()
+
+        if not healthy:
+            self._discard(conn)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            result = dict(self._stats)
+            result["size"] = self.size
+            result["open"] = self._created
+            result["idle"] = len(self._idle)
+            result["in_use"] = self._created - len(self._idle)
+        acquired = result["acquired"] or 1
+        result["wait_time_avg"] = result["wait_time_total"] / acquired
+        return result
 
+    def close_all(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._created -= len(idle)
+        for conn, _ in idle:
+            self._discard(conn)
 
 
-# ====== USERS ======
+_pool = ConnectionPool(DB_CONFIG, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_PING_INTERVAL)
 
-def create_or_update_user(telegram_id: int, username: Optional[str], info: Optional[str]):
-    conn = get_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO users (telegram_id, username, info, last_activity)
-            VALUES (%s, %s, %s, NOW())
-            ON DUPLICATE KEY UPDATE
-              username = VALUES(username),
-              info = VALUES(info),
-              last_activity = NOW()
-            """,
-            (telegram_id, username, info)
-        )
-        conn.commit()
-    finally:
-        cur.close()
-        conn.close()
 
+def get_connection() -> PooledConnection:
+    return _pool.acquire()
 
-def update_last_activity(telegram_id: int):
-    conn = get_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE users SET last_activity = NOW() WHERE telegram_id = %s",
-            (telegram_id,)
-        )
-        conn.commit()
-    finally:
-        cur.close()
-        conn.close()
+
+def pool_stats() -> Dict:
+    return _pool.stats()
 
 
-def get_all_users_from_db() -> List[Dict]:
+def _stream(sql: str, params: tuple = (), chunk_size: int = DB_STREAM_CHUNK, convert=None):
+    # Потоковая выборка: небуферизованный курсор, строки идут с сервера кусками
+    # по chunk_size, в памяти не больше одного куска. Соединение занято, пока
+    # генератор не дочитан или не закрыт.
     conn = get_connection()
+    cur = conn.cursor(dictionary=True)
     try:
-        cur = conn.cursor(dictionary=True)
-        cur.execute("SELECT telegram_id, username, info, last_activity FROM users")
-        rows = cur.fetchall()
-        return rows
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [convert(row) for row in rows] if convert else rows
     finally:
+        try:
+            # генератор могли закрыть посреди выборки — дочитываем остаток
+            conn.consume_results()
+        except Exception:
+            pass
         cur.close()
         conn.close()
 
 
-def update_info_in_db(telegram_id: int, info: str):
+
+# ====== USERS ======
+
+_SQL_UPSERT_USER = """
+    INSERT INTO users (telegram_id, username, info, last_activity)
+    VALUES (%s, %s, %s, NOW())
+    ON DUPLICATE KEY UPDATE
+      username = VALUES(username),
+      info = VALUES(info),
+      last_activity = NOW()
+"""
+_SQL_UPDATE_LAST_ACTIVITY = "UPDATE users SET last_activity = NOW() WHERE telegram_id = %s"
+_SQL_UPDATE_INFO = "UPDATE users SET info = %s WHERE telegram_id = %s"
+def create_or_update_user(telegram_id: int, username: Optional[str], info: Optional[str]):
     conn = get_connection()
     try:
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE users SET info = %s WHERE telegram_id = %s",
-            (info, telegram_id)
-        )
+        cur = conn.prepared(_SQL_UPSERT_USER)
+        cur.execute(_SQL_UPSERT_USER, (telegram_id, username, info))
         conn.commit()
     finally:
-        cur.close()
         conn.close()
 
 
-def get_user_by_telegram_id(telegram_id: int) -> Optional[Dict]:
+def update_last_activity(telegram_id: int):
     conn = get_connection()
     try:
-        cur = conn.cursor(dictionary=True)
-        cur.execute(
-            "SELECT telegram_id, username, info, last_activity FROM users WHERE telegram_id = %s",
-            (telegram_id,)
-        )
-        row = cur.fetchone()
-        return row
+        cur = conn.prepared(_SQL_UPDATE_LAST_ACTIVITY)
+        cur.execute(_SQL_UPDATE_LAST_ACTIVITY, (telegram_id,))
+        conn.commit()
     finally:
-        cur.close()
         conn.close()
 
 
-def set_login_code(telegram_id: int, code: Optional[str]):
+def update_info_in_db(telegram_id: int, info: str):
     conn = get_connection()
     try:
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE users SET login_code = %s WHERE telegram_id = %s",
-            (code, telegram_id),
-        )
+        cur = conn.prepared(_SQL_UPDATE_INFO)
+        cur.execute(_SQL_UPDATE_INFO, (info, telegram_id))
         conn.commit()
     finally:
-        cur.close()
         conn.close()
 
 
 # ====== ПУБЛИЧНЫЙ ЧАТ ======
 
-def save_public_message(user_id: int, username: str, text: str):
+def save_public_messages(rows: List[Dict]) -> List[int]:
+    # Пачка сообщений одним multi-row INSERT, id строк — вторым запросом.
+    # Считать их от первого нельзя: при interleaved-режиме автоинкремента
+    # (по умолчанию в MySQL 8) или auto_increment_increment > 1 id идут не подряд.
+    # Все строки пачки помечены случайным write_batch; они не меньше LAST_INSERT_ID()
+    # и растут в порядке VALUES, так что выборка идёт по хвосту первичного ключа.
+    if not rows:
+        return []
+
+    batch = secrets.token_hex(8)
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+    params = []
+    for row in rows:
+        params.extend((row["user_id"], row["username"], row["text"], row["created_at"], batch))
+
     conn = get_connection()
     try:
         cur = conn.cursor()
         cur.execute(
-            "INSERT INTO chat_messages (user_id, username, text) VALUES (%s, %s, %s)",
-            (user_id, username, text)
+            "INSERT INTO chat_messages (user_id, username, text, created_at, write_batch) "
+            f"VALUES {placeholders}",
+            params
         )
-        conn.commit()
-    finally:
-        cur.close()
-        conn.close()
-
-
-def get_public_messages(limit: int = 200) -> List[Dict]:
-    conn = get_connection()
-    try:
-        cur = conn.cursor(dictionary=True)
         cur.execute(
-            """
-            SELECT user_id, username, text, created_at
-            FROM chat_messages
-            ORDER BY created_at ASC
-            LIMIT %s
-            """,
-            (limit,)
+            "SELECT id FROM chat_messages WHERE id >= %s AND write_batch = %s ORDER BY id",
+            (cur.lastrowid, batch)
         )
-        return cur.fetchall()
+        ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        return ids
     finally:
         cur.close()
         conn.close()
 
 
-# ====== СТАТУС ЗВЁЗД (user_stars) ======
+_SQL_MESSAGES_AFTER = """
+    SELECT id, user_id, username, text, created_at
+    FROM chat_messages
+    WHERE id > %s
+    ORDER BY id ASC
+    LIMIT %s
+"""
+_SQL_MESSAGES_BEFORE = """
+    SELECT id, user_id, username, text, created_at
+    FROM chat_messages
+    WHERE id < %s
+    ORDER BY id DESC
+    LIMIT %s
+"""
+_SQL_MESSAGES_LATEST = """
+    SELECT id, user_id, username, text, created_at
+    FROM chat_messages
+    ORDER BY id DESC
+    LIMIT %s
+"""
+
+
+def get_public_messages(
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> List[Dict]:
+    # Keyset-пагинация по первичному ключу id, от новых к старым:
+    #   before_id — страница сообщений старше курсора,
+    #   after_id  — ближайшие limit сообщений новее курсора.
+    # Оба варианта — range scan по кластерному индексу, без filesort и OFFSET.
+    if after_id is not None:
+        sql, params = _SQL_MESSAGES_AFTER, (after_id, limit)
+    elif before_id is not None:
+        sql, params = _SQL_MESSAGES_BEFORE, (before_id, limit)
+    else:
+        sql, params = _SQL_MESSAGES_LATEST, (limit,)
 
-def get_star_state(user_id: int) -> Optional[Dict]:
     conn = get_connection()
     try:
-        cur = conn.cursor(dictionary=True)
-        cur.execute(
-            """
-            SELECT user_id, activity_score, star_color, star_shape, info, skins_owned
-            FROM user_stars
-            WHERE user_id = %s
-            """,
-            (user_id,)
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        skins_raw = row.get("skins_owned")
-        if skins_raw is None:
-            skins = []
-        else:
-            if isinstance(skins_raw, str):
-                try:
-                    skins = json.loads(skins_raw)
-                except Exception:
-                    skins = []
-            else:
-                skins = skins_raw
-        return {
-            "user_id": row["user_id"],
-            "activity_score": float(row["activity_score"]),
-            "star_color": row["star_color"],
-            "star_shape": row["star_shape"],
-            "info": row.get("info") or "",
-            "skins_owned": skins,
-        }
+        cur = conn.prepared(sql)
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        return rows[::-1] if after_id is not None else rows
     finally:
-        cur.close()
         conn.close()
 
 
-def upsert_star_state(
-    user_id: int,
-    activity_score: float,
-    star_color: str,
-    star_shape: str,
-    info: str,
-    skins_owned: Optional[list],
-):
-    if skins_owned is None:
-        skins_owned = []
-    skins_json = json.dumps(skins_owned, ensure_ascii=False)
+# ====== СТАТУС ЗВЁЗД (user_stars) ======
+
+def _parse_skins(skins_raw) -> list:
+    if skins_raw is None:
+        return []
+    # колонка JSON (миграция 3) может прийти из драйвера байтами
+    if isinstance(skins_raw, (bytes, bytearray)):
+        skins_raw = skins_raw.decode("utf-8")
+    if isinstance(skins_raw, str):
+        try:
+            return json.loads(skins_raw)
+        except Exception:
+            return []
+    return skins_raw
+
+
+def _star_from_row(row: Dict, info_key: str = "info") -> Dict:
+    return {
+        "user_id": row["user_id"],
+        "activity_score": float(row["activity_score"]),
+        "activity_at": float(row["activity_at"]) if row.get("activity_at") is not None else None,
+        "star_color": row["star_color"],
+        "star_shape": row["star_shape"],
+        "info": row.get(info_key) or "",
+        "skins_owned": _parse_skins(row.get("skins_owned")),
+    }
+
+
+def upsert_star_states(rows: List[Dict]):
+    # Пачка строк одним INSERT ... ON DUPLICATE KEY UPDATE вместо запроса на каждую звезду.
+    # Обычным курсором: размер пачки каждый раз свой, и подготовленный запрос
+    # на каждое число строк только вытеснял бы из кэша соединения горячие.
+    if not rows:
+        return
+
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(rows))
+    params = []
+    for row in rows:
+        params.extend((
+            row["user_id"],
+            row["activity_score"],
+            row.get("activity_at"),
+            row["star_color"],
+            row["star_shape"],
+            row["info"],
+            json.dumps(row.get("skins_owned") or [], ensure_ascii=False),
+        ))
 
     conn = get_connection()
     try:
         cur = conn.cursor()
         cur.execute(
-            """
-            INSERT INTO user_stars (user_id, activity_score, star_color, star_shape, info, skins_owned)
-            VALUES (%s, %s, %s, %s, %s, %s)
+            f"""
+            INSERT INTO user_stars (user_id, activity_score, activity_at, star_color, star_shape, info, skins_owned)
+            VALUES {placeholders}
             ON DUPLICATE KEY UPDATE
               activity_score = VALUES(activity_score),
+              activity_at    = VALUES(activity_at),
               star_color     = VALUES(star_color),
               star_shape     = VALUES(star_shape),
               info           = VALUES(info),
               skins_owned    = VALUES(skins_owned)
             """,
-            (user_id, activity_score, star_color, star_shape, info, skins_json)
+            params
         )
         conn.commit()
     finally:
@@ -222,48 +452,112 @@ def upsert_star_state(
         conn.close()
 
 
-def get_all_star_states() -> List[Dict]:
+def _star_with_user_from_row(row: Dict) -> Dict:
+    star = _star_from_row(row)
+    star["username"] = row["username"]
+    star["user_info"] = row["user_info"]
+    return star
+
+
+def iter_stars_with_users(chunk_size: int = DB_STREAM_CHUNK):
+    # Все звёзды неба вместе с именем владельца одним потоковым запросом —
+    # вместо двух полных выборок и склейки по словарю в Python.
+    yield from _stream(
+        """
+        SELECT s.user_id, s.activity_score, s.activity_at, s.star_color, s.star_shape, s.info, s.skins_owned,
+               u.username, u.info AS user_info
+        FROM user_stars s
+        LEFT JOIN users u ON u.telegram_id = s.user_id
+        """,
+        (),
+        chunk_size,
+        _star_with_user_from_row,
+    )
+
+
+# ====== ПОЛЬЗОВАТЕЛЬ + ЗВЕЗДА ОДНИМ ЗАПРОСОМ ======
+
+_USER_WITH_STAR_COLUMNS = """
+    u.telegram_id, u.username, u.info AS user_info,
+    s.user_id, s.activity_score, s.activity_at, s.star_color, s.star_shape, s.info, s.skins_owned
+"""
+
+
+def _split_user_star(row: Dict) -> Dict:
+    db_user = None
+    if row["telegram_id"] is not None:
+        db_user = {
+            "telegram_id": row["telegram_id"],
+            "username": row["username"],
+            "info": row["user_info"],
+        }
+    star = _star_from_row(row) if row["user_id"] is not None else None
+    return {"user": db_user, "star": star}
+
+
+# users и user_stars за один round-trip; вторая ветка — звезда без строки в users
+_SQL_USER_WITH_STAR = f"""
+    SELECT {_USER_WITH_STAR_COLUMNS}
+    FROM users u
+    LEFT JOIN user_stars s ON s.user_id = u.telegram_id
+    WHERE u.telegram_id = %s
+    UNION ALL
+    SELECT {_USER_WITH_STAR_COLUMNS}
+    FROM user_stars s
+    LEFT JOIN users u ON u.telegram_id = s.user_id
+    WHERE s.user_id = %s AND u.telegram_id IS NULL
+"""
+
+
+def get_user_with_star(user_id: int) -> Optional[Dict]:
     conn = get_connection()
     try:
-        cur = conn.cursor(dictionary=True)
-        cur.execute(
-            """
-            SELECT user_id, activity_score, star_color, star_shape, info, skins_owned
-            FROM user_stars
-            """
-        )
+        cur = conn.prepared(_SQL_USER_WITH_STAR)
+        cur.execute(_SQL_USER_WITH_STAR, (user_id, user_id))
         rows = cur.fetchall()
-        result: List[Dict] = []
-        for row in rows:
-            skins_raw = row.get("skins_owned")
-            if skins_raw is None:
-                skins = []
-            else:
-                if isinstance(skins_raw, str):
-                    try:
-                        skins = json.loads(skins_raw)
-                    except Exception:
-                        skins = []
-                else:
-                    skins = skins_raw
-            result.append(
-                {
-                    "user_id": row["user_id"],
-                    "activity_score": float(row["activity_score"]),
-                    "star_color": row["star_color"],
-                    "star_shape": row["star_shape"],
-                    "info": row.get("info") or "",
-                    "skins_owned": skins,
-                }
-            )
-        return result
+        if not rows:
+            return None
+        return _split_user_star(rows[0])
     finally:
-        cur.close()
         conn.close()
+
+
+def iter_users_with_stars(limit: int, chunk_size: int = DB_STREAM_CHUNK):
+    # Потоковая выборка для прогрева кэша, сначала — недавно активные
+    yield from _stream(
+        f"""
+        SELECT {_USER_WITH_STAR_COLUMNS}
+        FROM users u
+        LEFT JOIN user_stars s ON s.user_id = u.telegram_id
+        ORDER BY u.last_activity DESC
+        LIMIT %s
+        """,
+        (limit,),
+        chunk_size,
+        _split_user_star,
+    )
+
+
 if __name__ == "__main__":
+    import sys
+
+    # python db.py          — проверить соединение
+    # python db.py migrate  — применить миграции схемы (migrations.py)
+    # python db.py status   — какие миграции применены
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
     try:
-        conn = get_connection()
-        print("Connected:", conn.is_connected())
-        conn.close()
+        if command == "migrate":
+            import migrations
+            applied = migrations.migrate()
+            print("Applied:", applied or "nothing, schema is up to date")
+        elif command == "status":
+            import migrations
+            for version, name, applied in migrations.status():
+                print(f"{version:>4}  {'applied' if applied else 'pending'}  {name}")
+        else:
+            conn = get_connection()
+            print("Connected:", conn.is_connected())
+            conn.close()
+            print("Pool:", pool_stats())
     except Error as e:
         print("DB error:", e)
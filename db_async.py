@@ -0,0 +1,100 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Dict, Optional
+
+import db
+import migrations
+
+
+# Больше потоков, чем соединений в пуле, смысла нет: лишние всё равно будут ждать соединение.
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", str(db.DB_POOL_SIZE)))
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+
+async def run_db(func, *args, **kwargs):
+    # Выполняет синхронную функцию из db.py в пуле потоков, не блокируя event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
+
+
+def pool_stats() -> Dict:
+    # счётчики пула в памяти, БД не трогает — можно звать прямо из event loop
+    return db.pool_stats()
+
+
+async def iter_chunks(gen):
+    # Потоковая выборка из db.py: каждый следующий кусок читается в пуле потоков,
+    # соединение держит сам генератор до конца выборки или до закрытия
+    try:
+        while True:
+            chunk = await run_db(next, gen, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        await run_db(gen.close)
+
+
+# ====== USERS ======
+
+async def create_or_update_user(telegram_id: int, username: Optional[str], info: Optional[str]):
+    return await run_db(db.create_or_update_user, telegram_id, username, info)
+
+
+async def update_last_activity(telegram_id: int):
+    return await run_db(db.update_last_activity, telegram_id)
+
+
+async def update_info_in_db(telegram_id: int, info: str):
+    return await run_db(db.update_info_in_db, telegram_id, info)
+
+
+# ====== ПУБЛИЧНЫЙ ЧАТ ======
+
+async def save_public_messages(rows: List[Dict]) -> List[int]:
+    return await run_db(db.save_public_messages, rows)
+
+
+async def get_public_messages(
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> List[Dict]:
+    return await run_db(db.get_public_messages, limit, before_id, after_id)
+
+
+# ====== СТАТУС ЗВЁЗД (user_stars) ======
+
+async def upsert_star_states(rows: List[Dict]):
+    return await run_db(db.upsert_star_states, rows)
+
+
+def iter_stars_with_users(chunk_size: int = db.DB_STREAM_CHUNK):
+    return iter_chunks(db.iter_stars_with_users(chunk_size))
+
+
+# ====== ПОЛЬЗОВАТЕЛЬ + ЗВЕЗДА ОДНИМ ЗАПРОСОМ ======
+
+async def get_user_with_star(user_id: int) -> Optional[Dict]:
+    return await run_db(db.get_user_with_star, user_id)
+
+
+def iter_users_with_stars(limit: int, chunk_size: int = db.DB_STREAM_CHUNK):
+    return iter_chunks(db.iter_users_with_stars(limit, chunk_size))
+
+
+# ====== МИГРАЦИИ ======
+
+async def pending_migrations() -> List[int]:
+    return [version for version, _, applied in await run_db(migrations.status) if not applied]
+
+
+async def migrate() -> List[int]:
+    return await run_db(migrations.migrate)
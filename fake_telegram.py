@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+import os
+import socket
+import sys
+import time
+from typing import Dict, List
+
+from aiohttp import ClientSession, web
+
+
+# ====== ФЕЙКОВЫЙ BOT API ======
+# Локальная замена api.telegram.org, чтобы гонять webhook-режим бота без сети:
+# отвечает на методы Bot API правдоподобными объектами и запоминает все вызовы.
+#
+#   python fake_telegram.py serve 8081
+#       только сервер; бота запускаем с TELEGRAM_API_URL=http://127.0.0.1:8081
+#   python fake_telegram.py check
+#       поднимает сервер, сайт и webhook-пул бота в одном процессе, шлёт /chat
+#       из нескольких чатов и проверяет, что ответы пришли все, апдейты одного
+#       чата обрабатывались по одному, а POST без секрета отвергнут. БД не нужна.
+
+FAKE_REPLY_DELAY = float(os.environ.get("FAKE_REPLY_DELAY", "0.05"))
+
+
+class FakeTelegram:
+    def __init__(self, reply_delay: float = 0.0):
+        self.reply_delay = reply_delay
+        self.calls: List[Dict] = []
+        # сколько sendMessage в чат обрабатывается прямо сейчас и максимум за всё время
+        self.in_flight: Dict[int, int] = {}
+        self.max_in_flight: Dict[int, int] = {}
+        self.max_total_in_flight = 0
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def sent_to(self, chat_id: int) -> List[Dict]:
+        return [c for c in self.calls if c["method"] == "sendMessage" and c["chat_id"] == chat_id]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        # aiogram шлёт параметры формой, значения — строки
+        params = dict(await request.post())
+        call = {"method": method, "params": params, "at": time.time()}
+        self.calls.append(call)
+
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake"}})
+        if method != "sendMessage":
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(params["chat_id"])
+        call["chat_id"] = chat_id
+        self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+        self.max_in_flight[chat_id] = max(self.max_in_flight.get(chat_id, 0), self.in_flight[chat_id])
+        self.max_total_in_flight = max(self.max_total_in_flight, sum(self.in_flight.values()))
+        try:
+            await asyncio.sleep(self.reply_delay)
+        finally:
+            self.in_flight[chat_id] -= 1
+
+        return web.json_response({
+            "ok": True,
+            "result": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            },
+        })
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> Dict:
+    # апдейт с личным сообщением, как его присылает Telegram
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            if text.startswith("/") else None,
+        },
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def check(chats: int = 4, per_chat: int = 5) -> bool:
+    fake = FakeTelegram(FAKE_REPLY_DELAY)
+    os.environ["TELEGRAM_API_URL"] = await fake.start()
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ.setdefault("WEBHOOK_BASE_URL", "http://fake.invalid")
+
+    # main читает настройки бота при импорте
+    import main
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    bot_task = asyncio.create_task(main.run_bot_webhook())
+
+    ok = False
+    try:
+        while not server.started or main.bot_updates is None:
+            await asyncio.sleep(0.01)
+
+        headers = {"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET}
+        url = f"http://127.0.0.1:{port}{main.WEBHOOK_PATH}"
+        chat_ids = [1000 + i for i in range(chats)]
+        update_ids = itertools.count(1)
+
+        async with ClientSession() as session:
+            # чужой POST без секрета апдейтом не становится
+            async with session.post(url, json=make_update(0, chat_ids[0], "/chat")) as resp:
+                rejected = resp.status == 401
+            for _ in range(per_chat):
+                for chat_id in chat_ids:
+                    async with session.post(url, json=make_update(next(update_ids), chat_id, "/chat"), headers=headers) as resp:
+                        if resp.status != 200:
+                            print("FAIL webhook answered", resp.status)
+                            return False
+
+        deadline = time.monotonic() + 10 + chats * per_chat * FAKE_REPLY_DELAY
+        while any(len(fake.sent_to(c)) < per_chat for c in chat_ids) and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+
+        registered = any(
+            c["method"] == "setWebhook" and c["params"].get("secret_token") == main.WEBHOOK_SECRET
+            for c in fake.calls
+        )
+        replies = {c: len(fake.sent_to(c)) for c in chat_ids}
+        per_chat_max = max(fake.max_in_flight.values(), default=0)
+        print("setWebhook with secret:", registered)
+        print("update without secret rejected:", rejected)
+        print("replies per chat:", replies)
+        print("max in flight per chat:", per_chat_max, "total:", fake.max_total_in_flight)
+
+        ok = (
+            registered
+            and rejected
+            and all(n == per_chat for n in replies.values())
+            and per_chat_max == 1
+            and (fake.max_total_in_flight > 1 or main.BOT_WEBHOOK_WORKERS == 1)
+        )
+    finally:
+        bot_task.cancel()
+        server.should_exit = True
+        await asyncio.gather(bot_task, server_task, return_exceptions=True)
+        await main.bot.session.close()
+        await fake.stop()
+
+    print("OK" if ok else "FAIL")
+    return ok
+
+
+async def serve(port: int):
+    fake = FakeTelegram(FAKE_REPLY_DELAY)
+    url = await fake.start(port=port)
+    print("fake Bot API on", url)
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await fake.stop()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "serve":
+        asyncio.run(serve(int(sys.argv[2]) if len(sys.argv) > 2 else 8081))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "check":
+        sys.exit(0 if asyncio.run(check()) else 1)
+    else:
+        print("usage: python fake_telegram.py serve [port] | check")
+        sys.exit(2)
@@ -1,40 +1,55 @@
 # main.py (исправленная версия)
 
 import os
+import argparse
 import asyncio
-from typing import List, Dict, Optional
-from datetime import datetime, timedelta
+import time
+from typing import List, Dict, Optional, Set
 import json
+import hashlib
+import hmac
+import itertools
 import secrets
+import signal
 import string
+from datetime import datetime
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
+from fastapi import APIRouter, FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 
 from aiogram import Bot, Dispatcher, F, Router
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, Update
+from aiogram.types.update import UpdateTypeLookupError
 from aiogram.filters import CommandStart, Command
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.exceptions import TelegramNetworkError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
-from db import (
+# Все обращения к MySQL идут через пул потоков, чтобы не блокировать event loop
+from db_async import (
     create_or_update_user,
     update_last_activity,
-    get_all_users_from_db,
     update_info_in_db,
-    get_user_by_telegram_id,
-    save_public_message,
+    get_user_with_star,
+    iter_users_with_stars,
+    save_public_messages,
     get_public_messages,
-    upsert_star_state,
-    get_all_star_states,
-    set_login_code,
-    get_connection,
-    get_star_state,
+    upsert_star_states,
+    iter_stars_with_users,
 )
+import db_async
+from star_state import ActivityScores, StarsSnapshot, StarUser, StarUserCache
+from ws_broadcast import ClientConnection, Coalescer, broadcast_json
+from chat_history import ChatJournal, RecentMessages
+from backplane import create_backplane
+from ratelimit import RateLimiter
+from sky_tiles import TileSubscriptions, parse_rect, parse_tiles, star_position, star_tile
 
 import uvicorn
 
@@ -42,15 +57,64 @@ import uvicorn
 
 BOT_TOKEN = "8127084344:AAHPVcpT2-USGSUQftgSR0OzCXlhO1fi5TA"
 
+# polling — long polling (по умолчанию), webhook — Telegram сам шлёт апдейты на сайт
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# публичный адрес сайта, на который Telegram будет слать апдейты, например https://stars.example.com
+WEBHOOK_BASE_URL = os.environ.get("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+# Без секрета маршрут принял бы POST от кого угодно с любым from.id. Если он не
+# задан, берём случайный и передаём его Telegram в set_webhook — поэтому тогда
+# нужен WEBHOOK_BASE_URL (см. role_error).
+WEBHOOK_SECRET_SET = bool(os.environ.get("WEBHOOK_SECRET"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "") or secrets.token_urlsafe(32)
+# сколько апдейтов обрабатываем одновременно (по одному на чат) и сколько всего ждут в очередях
+BOT_WEBHOOK_WORKERS = int(os.environ.get("BOT_WEBHOOK_WORKERS", "16"))
+BOT_WEBHOOK_QUEUE = int(os.environ.get("BOT_WEBHOOK_QUEUE", "1000"))
+# свой адрес Bot API (локальный bot-api сервер или фейк для тестов)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+
 bot = Bot(
     token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML),
 )
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
-app = FastAPI()
+# Шина между воркерами: по умолчанию в памяти процесса, для нескольких
+# воркеров/машин — BACKPLANE_URL=unix:///tmp/stars.sock или tcp://host:port
+backplane = create_backplane()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Под main() фоновые задачи уже запущены и их остановит main(). Но по SIGTERM
+    # uvicorn после shutdown сам добивает процесс сигналом, и до stop_process()
+    # дело не доходит — поэтому несохранённое сбрасываем здесь, при любом выходе.
+    # Под uvicorn main:app каждый воркер сам поднимает задачи своей роли и
+    # останавливает их при выключении. Роль по умолчанию — web, как и было до
+    # ролей: all в каждом из --workers N запустил бы N поллеров на один токен.
+    # all и bot — только если их попросили явно через ROLE.
+    if process_tasks is not None:
+        try:
+            yield
+        finally:
+            await flush_pending()
+        return
+
+    role = os.environ.get("ROLE", "web")
+    error = role_error(role)
+    if error:
+        raise RuntimeError(error)
+    tasks = await start_process(role)
+    try:
+        yield
+    finally:
+        await stop_process(tasks)
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -71,108 +135,279 @@ async def root():
 # ================== WS: stars ==================
 
 class StarsWSManager:
+    # Клиент может прислать окно просмотра ({"type": "viewport", ...}) —
+    # тогда изменения звёзд он получает только по своим тайлам неба.
+    # Без окна клиент, как и раньше, получает всё небо.
+
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[ClientConnection] = set()
+        self.view = TileSubscriptions()
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket) -> ClientConnection:
         await websocket.accept()
-        self.active_connections.append(websocket)
+        conn = ClientConnection(websocket, on_close=self.disconnect)
+        self.active_connections.add(conn)
+        self.view.add(conn)
+        return conn
+
+    def disconnect(self, conn: ClientConnection):
+        self.active_connections.discard(conn)
+        self.view.remove(conn)
+        conn.close()
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+    async def broadcast_star(self, data: dict):
+        # изменение одной звезды — всему небу и тем, кто смотрит её тайл
+        subs = self.view.by_tile.get(star_tile(data["id"]), ())
+        broadcast_json(itertools.chain(self.view.whole_sky, subs), data)
 
-    async def broadcast_json(self, data: dict):
-        to_remove = []
-        for ws in self.active_connections:
-            try:
-                await ws.send_json(data)
-            except Exception:
-                to_remove.append(ws)
-        for ws in to_remove:
-            self.disconnect(ws)
+    async def broadcast_stars(self, msg_type: str, stars: List[Dict]):
+        # Пачка целиком уходит всему небу, а подписчику тайлов — тоже одним
+        # кадром, но только со звёздами его окна. seq у всех кадров общий:
+        # это последнее изменение, учтённое в пачке.
+        seq = max(s["seq"] for s in stars)
+        if self.view.whole_sky:
+            broadcast_json(self.view.whole_sky, {"type": msg_type, "stars": stars, "seq": seq})
+        for conn, group in self.view.group_by_conn(stars).items():
+            broadcast_json((conn,), {"type": msg_type, "stars": group, "seq": seq})
 
 
 ws_manager = StarsWSManager()
 
-# in-memory кэш
-users: Dict[int, Dict] = {}
+# сколько секунд после последнего действия звезда считается активной
+ACTIVE_WINDOW = 60.0
+
+# in-memory кэш: не больше USER_CACHE_CAPACITY звёзд, простаивающие дольше
+# USER_CACHE_TTL секунд выгружаются, неизвестные id помним USER_CACHE_NEGATIVE_TTL секунд
+USER_CACHE_CAPACITY = int(os.environ.get("USER_CACHE_CAPACITY", "100000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "3600"))
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get("USER_CACHE_NEGATIVE_TTL", "60"))
+# и не больше USER_CACHE_NEGATIVE_CAPACITY неизвестных id
+USER_CACHE_NEGATIVE_CAPACITY = int(os.environ.get("USER_CACHE_NEGATIVE_CAPACITY", "10000"))
+
+
+def on_user_evicted(user: StarUser):
+    # несохранённое состояние уезжает в очередь write-behind до удаления из кэша
+    if user.id in dirty_star_ids:
+        dirty_star_ids.discard(user.id)
+        evicted_star_rows[user.id] = star_state_row(user)
+    activity_scores.release(user.id)
+    recently_active_ids.discard(user.id)
+
+
+users = StarUserCache(
+    USER_CACHE_CAPACITY,
+    USER_CACHE_TTL,
+    USER_CACHE_NEGATIVE_TTL,
+    can_evict=lambda user: not is_active(user),
+    on_evict=on_user_evicted,
+    negative_capacity=USER_CACHE_NEGATIVE_CAPACITY,
+)
+
 
+def set_last_active(user: StarUser):
+    user.last_active = time.monotonic()
+    recently_active_ids.add(user.id)
 
-def get_last_active(user: Dict) -> Optional[datetime]:
-    iso = user.get("last_active_iso")
-    if not iso:
-        return None
-    try:
-        return datetime.fromisoformat(iso)
-    except Exception:
-        return None
 
+def is_active(user: StarUser) -> bool:
+    if not user.last_active:
+        return False
+    return time.monotonic() - user.last_active <= ACTIVE_WINDOW
 
-def set_last_active(user: Dict):
-    user["last_active_iso"] = datetime.utcnow().isoformat()
 
+# Очки активности живут отдельно от словарей пользователей и затухают лениво:
+# 0.05 в секунду — те же 0.5 за 10 секунд, что раньше списывал цикл затухания.
+ACTIVITY_DECAY_PER_SEC = float(os.environ.get("ACTIVITY_DECAY_PER_SEC", "0.05"))
+activity_scores = ActivityScores(ACTIVITY_DECAY_PER_SEC)
 
-def is_active(user: Dict) -> bool:
-    last = get_last_active(user)
-    if not last:
-        return False
-    return datetime.utcnow() - last <= timedelta(minutes=1)
+# кто недавно был активен — чтобы вовремя погасить флаг active на небе
+recently_active_ids: Set[int] = set()
 
 
-def inc_activity(user: Dict, amount: float = 1.0):
-    score = float(user.get("activity_score", 0))
-    score = max(score + amount, 0.0)
-    user["activity_score"] = score
+def get_activity(user: StarUser) -> float:
+    return activity_scores.get(user.id)
 
 
-def dec_activity_all(amount: float = 1.0):
-    for u in users.values():
-        score = float(u.get("activity_score", 0))
-        score = max(score - amount, 0.0)
-        u["activity_score"] = score
+def inc_activity(user: StarUser, amount: float = 1.0):
+    activity_scores.add(user.id, amount)
 
 
-def generate_login_code(length: int = 6) -> str:
-    alphabet = string.ascii_uppercase + string.digits
-    return "".join(secrets.choice(alphabet) for _ in range(length))
+LOGIN_CODE_LENGTH = 6
+LOGIN_CODE_ALPHABET = string.ascii_uppercase + string.digits
+LOGIN_CODE_CHARS = frozenset(LOGIN_CODE_ALPHABET)
 
 
-def sync_star_state_to_db(user_id: int):
-    u = users.get(user_id)
-    if not u:
+def generate_login_code(length: int = LOGIN_CODE_LENGTH) -> str:
+    return "".join(secrets.choice(LOGIN_CODE_ALPHABET) for _ in range(length))
+
+
+# ================== Ограничение частоты ==================
+
+# Лимиты в формате "N/S" (N действий за S секунд), "0" — выключить.
+# Лишние действия отбрасываются до записи в БД и рассылки.
+# Счётчики в памяти процесса: при нескольких воркерах лимит действует на каждом.
+chat_message_limit = RateLimiter.from_spec(os.environ.get("RATE_LIMIT_CHAT_MESSAGE", "10/10"))
+chat_request_limit = RateLimiter.from_spec(os.environ.get("RATE_LIMIT_CHAT_REQUEST", "5/60"))
+# все кадры одного сокета, в том числе до авторизации
+chat_socket_limit = RateLimiter.from_spec(os.environ.get("RATE_LIMIT_CHAT_SOCKET", "30/10"))
+# /api/buy_skin и /api/update_info — по пользователю из проверенного токена сессии
+api_write_limit = RateLimiter.from_spec(os.environ.get("RATE_LIMIT_API_WRITE", "10/60"))
+# подбор кодов входа — по адресу клиента
+login_limit = RateLimiter.from_spec(os.environ.get("RATE_LIMIT_LOGIN", "10/60"))
+bot_message_limit = RateLimiter.from_spec(os.environ.get("RATE_LIMIT_BOT_MESSAGE", "20/30"))
+
+
+def rate_limited_response() -> JSONResponse:
+    return JSONResponse({"ok": False, "error": "rate_limited"}, status_code=429)
+
+
+# Сколько своих прокси стоит перед сайтом. Каждый дописывает адрес, от которого
+# получил запрос, в конец X-Forwarded-For, так что клиент — N-й адрес с конца,
+# а всё левее клиент мог прислать сам. Без этого за прокси у всех один адрес —
+# адрес прокси, и один скрипт выбирает login_limit за весь сайт.
+# На Render (там задана переменная RENDER) прокси один.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "1" if os.environ.get("RENDER") else "0"))
+
+
+def client_ip(request: Request) -> str:
+    if TRUSTED_PROXY_HOPS > 0:
+        hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+# ================== Write-behind для user_stars ==================
+
+# Изменения звёзд не пишутся в БД сразу: пользователь помечается «грязным»,
+# а star_flush_loop сбрасывает всех грязных пачками не реже раза в STAR_FLUSH_INTERVAL секунд.
+STAR_FLUSH_INTERVAL = float(os.environ.get("STAR_FLUSH_INTERVAL", "5"))
+STAR_FLUSH_BATCH = int(os.environ.get("STAR_FLUSH_BATCH", "500"))
+# При общем бэкплейне последняя строка каждой изменённой звезды лежит ещё и в нём
+# (star_row:<id>), пока узел-автор наверняка не записал её в БД: узел, у которого
+# пользователя нет в кэше, берёт её, а не отстающую строку из MySQL.
+STAR_ROW_TTL = float(os.environ.get("STAR_ROW_TTL", "600"))
+
+dirty_star_ids: Set[int] = set()
+# строки выгруженных из кэша пользователей, ещё не дошедшие до БД
+evicted_star_rows: Dict[int, Dict] = {}
+# строки, которые сейчас пишутся в БД: пока запись не закончилась, в БД старое
+flushing_star_rows: Dict[int, Dict] = {}
+star_flush_wakeup = asyncio.Event()
+
+
+def star_state_row(u: StarUser) -> Dict:
+    # очки пишутся вместе с моментом, к которому они относятся: затухание
+    # досчитывается при чтении, и строка меняется только от настоящих изменений
+    score, at = activity_scores.state(u.id)
+    return {
+        "user_id": u.id,
+        "activity_score": score,
+        "activity_at": at,
+        "star_color": u.star_color,
+        "star_shape": u.star_shape,
+        "info": u.info,
+        "skins_owned": u.skins_owned,
+    }
+
+
+def pending_star_row(user_id: int) -> Optional[Dict]:
+    # последняя строка звезды, которая ещё не дошла до БД (выгружена или пишется)
+    return evicted_star_rows.get(user_id) or flushing_star_rows.get(user_id)
+
+
+def mark_star_dirty(user_id: int):
+    dirty_star_ids.add(user_id)
+    if len(dirty_star_ids) >= STAR_FLUSH_BATCH:
+        star_flush_wakeup.set()
+
+
+async def flush_star_states():
+    global dirty_star_ids, evicted_star_rows
+    if not dirty_star_ids and not evicted_star_rows:
         return
-    activity_score = float(u.get("activity_score", 0.0))
-    star_color = u.get("star_color") or "#ffffff"
-    star_shape = u.get("star_shape") or "circle"
-    info = u.get("info") or ""
-    skins_owned = u.get("skins_owned", []) or []
+
+    # Состояние берём на момент сброса: 50 изменений одной звезды превращаются в одну строку
+    ids, dirty_star_ids = dirty_star_ids, set()
+    rows_by_id, evicted_star_rows = evicted_star_rows, {}
+    for uid in ids:
+        u = users.peek(uid)
+        if u:
+            rows_by_id[uid] = star_state_row(u)
+    rows = list(rows_by_id.values())
+    flushing_star_rows.update(rows_by_id)
+
     try:
-        upsert_star_state(
-            user_id=user_id,
-            activity_score=activity_score,
-            star_color=star_color,
-            star_shape=star_shape,
-            info=info,
-            skins_owned=skins_owned,
-        )
-    except Exception as e:
-        print("DEBUG sync_star_state_to_db error:", user_id, e)
+        for start in range(0, len(rows), STAR_FLUSH_BATCH):
+            chunk = rows[start:start + STAR_FLUSH_BATCH]
+            try:
+                await upsert_star_states(chunk)
+            except Exception as e:
+                print("DEBUG flush_star_states error:", len(chunk), e)
+                # не потеряем изменения: вернём несохранённых в очередь до следующей попытки
+                for row in rows[start:]:
+                    if row["user_id"] in users:
+                        dirty_star_ids.add(row["user_id"])
+                    else:
+                        evicted_star_rows.setdefault(row["user_id"], row)
+                return
+    finally:
+        # строку, которую за время записи сменила более новая, не трогаем
+        for row in rows:
+            if flushing_star_rows.get(row["user_id"]) is row:
+                del flushing_star_rows[row["user_id"]]
+
 
+async def star_flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(star_flush_wakeup.wait(), timeout=STAR_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        star_flush_wakeup.clear()
+        await flush_star_states()
+
+
+async def ensure_user_cached(user_id: int, create: bool = False) -> Optional[StarUser]:
+    # create=True — бот: пользователь пишет нам сам, заводим звезду даже без записи в БД.
+    # Для сайта неизвестный id не создаётся и запоминается в отрицательном кэше.
+    u = users.get(user_id)
+    if u:
+        return u
+    if not create and users.is_missing(user_id):
+        return None
 
-def ensure_user_cached(user_id: int):
+    # Выгруженный из кэша пользователь мог ещё не доехать до БД. Строку смотрим
+    # и до запроса: если запись закончится, пока мы читаем, из БД может прийти старое.
+    stashed = pending_star_row(user_id)
+    found = await get_user_with_star(user_id) or {}
+    # звезду мог только что поменять другой узел, а в БД она попадёт позже
+    latest = await backplane.get(f"star_row:{user_id}") if backplane.shared else None
+    # пока ждали БД, пользователя мог закэшировать другой обработчик
     if user_id in users:
-        return
+        return users[user_id]
+
+    db_user = found.get("user")
+    star = latest or pending_star_row(user_id) or stashed or found.get("star")
+
+    if not create and not db_user and not star:
+        users.mark_missing(user_id)
+        return None
+
+    return cache_user(user_id, db_user, star)
 
-    db_user = get_user_by_telegram_id(user_id)
-    star = get_star_state(user_id)
 
+def cache_user(
+    user_id: int,
+    db_user: Optional[Dict],
+    star: Optional[Dict],
+    cold: bool = False,
+) -> StarUser:
     username = (db_user["username"] if db_user else None) or f"user_{user_id}"
-    full_name = username
 
     activity_score = float(star["activity_score"]) if star else 0.0
-    star_color = star["star_color"] if star else "#ffffff"
-    star_shape = star["star_shape"] if star else "circle"
+    star_color = star["star_color"] if star else None
+    star_shape = star["star_shape"] if star else None
     info = ""
     if star and star.get("info"):
         info = star["info"]
@@ -183,50 +418,325 @@ def ensure_user_cached(user_id: int):
     if star and star.get("skins_owned"):
         skins = star["skins_owned"]
 
-    users[user_id] = {
-        "id": user_id,
-        "username": username,
-        "full_name": full_name,
-        "activity_score": activity_score,
-        "star_color": star_color,
-        "star_shape": star_shape,
-        "skins_owned": skins,
-        "info": info,
+    activity_scores.set(user_id, activity_score, star.get("activity_at") if star else None)
+    u = StarUser(
+        user_id,
+        username,
+        star_color=star_color,
+        star_shape=star_shape,
+        info=info,
+        skins_owned=skins,
+    )
+    users.put(user_id, u, cold=cold)
+    return u
+
+
+# Прогрев кэша при старте: один потоковый запрос users LEFT JOIN user_stars
+# вместо двух запросов на каждого пользователя при первом обращении.
+USER_CACHE_WARMUP = os.environ.get("USER_CACHE_WARMUP", "0") == "1"
+USER_CACHE_WARMUP_CHUNK = int(os.environ.get("USER_CACHE_WARMUP_CHUNK", "1000"))
+
+
+async def warmup_user_cache():
+    loaded = 0
+    async for chunk in iter_users_with_stars(users.capacity, USER_CACHE_WARMUP_CHUNK):
+        for found in chunk:
+            user_id = found["user"]["telegram_id"]
+            if user_id not in users:
+                cache_user(user_id, found["user"], found["star"], cold=True)
+                loaded += 1
+    print(f"User cache warmed up: {loaded} users")
+
+
+# ================== Снапшот неба ==================
+
+stars_snapshot = StarsSnapshot(ACTIVITY_DECAY_PER_SEC)
+stars_snapshot_lock = asyncio.Lock()
+
+
+def star_payload(u: StarUser) -> Dict:
+    # Одна и та же запись звезды уходит в /ws и лежит в снапшоте /api/stars.
+    # activity_score — очки на момент activity_at (unix-время); сколько их сейчас,
+    # клиент считает сам по decay_per_sec, так что с затуханием запись не меняется.
+    x, y = star_position(u.id)
+    score, at = activity_scores.state(u.id)
+    return {
+        "id": u.id,
+        "x": x,
+        "y": y,
+        "username": u.username,
+        "info": u.info or f"{u.full_name} уже на небе",
+        "active": is_active(u),
+        "activity_score": score,
+        "activity_at": round(at, 3),
+        "star_color": u.star_color,
+        "star_shape": u.star_shape,
     }
 
 
-# ================== Публичный чат API ==================
+# ====== Склейка activity_update ======
+# Изменения звёзд за окно STAR_BATCH_WINDOW уходят клиентам одним кадром
+# activity_batch, в котором по каждой звезде только последнее состояние.
+STAR_BATCH_WINDOW = float(os.environ.get("STAR_BATCH_WINDOW", "0.2"))
+
+
+async def broadcast_star_batch(stars: List[Dict]):
+    await ws_manager.broadcast_stars("activity_batch", stars)
+
+
+star_batch = Coalescer(STAR_BATCH_WINDOW, broadcast_star_batch)
+
+
+def queue_star_update(star: Dict):
+    star_batch.add(star["id"], {**star, "seq": stars_snapshot.seq})
+
+
+async def publish_star(u: StarUser, msg_type: str = "activity_update", **overrides):
+    # Изменение звезды уходит через бэкплейн на все узлы, включая этот;
+    # вместе с ним едет строка состояния, чтобы чужие кэши не отставали.
+    # Узлы без пользователя в кэше строку пропускают и при промахе читают её
+    # из star_row:<id> — туда она кладётся раньше публикации.
+    row = star_state_row(u)
+    if backplane.shared:
+        await backplane.set(f"star_row:{u.id}", row, ttl=STAR_ROW_TTL)
+    await backplane.publish("stars", {
+        "origin": backplane.node_id,
+        "type": msg_type,
+        "star": star_payload(u),
+        "row": row,
+        "overrides": overrides,
+    })
+
+
+# Процесс-планировщик сам никого не обслуживает и держит в кэше все звёзды,
+# о которых слышит от других узлов, чтобы гасить их флаг active по таймеру.
+mirror_remote_stars = False
+
+
+def apply_remote_star(row: Dict, active: bool):
+    # звезду поменял другой узел: обновляем свою копию, если она есть в кэше
+    u = users.peek(row["user_id"])
+    if not u:
+        return
+    u.info = row["info"]
+    u.skins_owned = row["skins_owned"]
+    u.star_color = row["star_color"]
+    u.star_shape = row["star_shape"]
+    activity_scores.set(u.id, row["activity_score"], row["activity_at"])
+    if active and mirror_remote_stars:
+        set_last_active(u)
+
+
+async def on_star_message(msg: Dict):
+    star = msg["star"]
+    stars_snapshot.update(star)
+    if msg["origin"] != backplane.node_id:
+        if mirror_remote_stars and star["id"] not in users:
+            await ensure_user_cached(star["id"])
+        apply_remote_star(msg["row"], star["active"])
+    if msg["type"] == "activity_update" and not msg["overrides"]:
+        queue_star_update(star)
+        return
+    await ws_manager.broadcast_star({
+        "type": msg["type"],
+        **star,
+        **msg["overrides"],
+        "seq": stars_snapshot.seq,
+    })
+
+
+backplane.subscribe("stars", on_star_message)
+
+
+async def load_stars_from_db() -> List[Dict]:
+    # звёзды вместе с именами владельцев одним потоковым запросом, кусками
+    result = []
+    # у строк без activity_at очки считаем снятыми сейчас, как и в cache_user
+    loaded_at = round(time.time(), 3)
+
+    async for chunk in iter_stars_with_users():
+        for row in chunk:
+            tg_id = row["user_id"]
+            local = users.peek(tg_id)
+
+            # у закэшированных звёзд память свежее БД (write-behind и затухание)
+            if local:
+                result.append(star_payload(local))
+                continue
+
+            username = row["username"] or f"user_{tg_id}"
+            info = row["info"] or row["user_info"] or f"{username} уже на небе"
+            x, y = star_position(tg_id)
+
+            result.append(
+                {
+                    "id": tg_id,
+                    "x": x,
+                    "y": y,
+                    "username": username,
+                    "info": info,
+                    "active": False,
+                    "activity_score": row["activity_score"],
+                    "activity_at": row["activity_at"] if row["activity_at"] is not None else loaded_at,
+                    "star_color": row["star_color"] or "#ffffff",
+                    "star_shape": row["star_shape"] or "circle",
+                }
+            )
+
+    return result
+
+
+async def ensure_stars_snapshot():
+    if stars_snapshot.loaded:
+        return
+    async with stars_snapshot_lock:
+        if not stars_snapshot.loaded:
+            stars_snapshot.load(await load_stars_from_db())
+
+
+def parse_int(raw) -> Optional[int]:
+    try:
+        return int(raw) if raw is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def stars_delta(since: int, epoch: Optional[str], tiles: Optional[Set[str]] = None) -> Dict:
+    # Клиент с чужим epoch (сервер перезапускался) или seq «из будущего» получает всё небо
+    # (или все звёзды своих тайлов, если tiles задан)
+    full = (epoch is not None and epoch != stars_snapshot.epoch) or since > stars_snapshot.seq
+    if tiles is not None:
+        stars = stars_snapshot.in_tiles(tiles, 0 if full else since)
+    else:
+        stars = list(stars_snapshot.stars.values()) if full else stars_snapshot.changes_since(since)
+    result = {
+        "epoch": stars_snapshot.epoch,
+        "seq": stars_snapshot.seq,
+        "full": full or since == 0,
+        "stars": stars,
+        # по ним клиент досчитывает затухание activity_score у себя
+        "decay_per_sec": ACTIVITY_DECAY_PER_SEC,
+        "now": round(time.time(), 3),
+    }
+    if tiles is not None:
+        result["tiles"] = sorted(tiles)
+    return result
+
+
+def parse_view(tiles_raw, rect_raw) -> Optional[Set[str]]:
+    # окно просмотра: список тайлов "tx:ty,..." или прямоугольник неба "x0,y0,x1,y1"
+    if tiles_raw is not None:
+        return parse_tiles(tiles_raw)
+    return parse_rect(rect_raw)
+
+
+# ================== История публичного чата ==================
+
+# последние CHAT_HISTORY_SIZE сообщений держим в памяти: «открыть чат»
+# отдаётся без MySQL, в БД ходим только за страницами постарше
+CHAT_HISTORY_SIZE = int(os.environ.get("CHAT_HISTORY_SIZE", "500"))
+CHAT_PAGE_LIMIT = 50
+CHAT_PAGE_MAX = 200
+
+recent_messages = RecentMessages(CHAT_HISTORY_SIZE)
+recent_messages_lock = asyncio.Lock()
+
+
+def chat_message_out(m: Dict) -> Dict:
+    return {"id": m["id"], "username": m["username"], "text": m["text"]}
+
+
+# Публичные сообщения пишутся в БД фоновым писателем пачками (ChatJournal):
+# CHAT_FLUSH_INTERVAL — как часто дописываем журнал (0 — сразу после сообщения),
+# CHAT_FLUSH_BATCH — строк в одном INSERT, CHAT_JOURNAL_SIZE — сколько
+# несохранённых сообщений держим, прежде чем перестать принимать новые.
+CHAT_FLUSH_INTERVAL = float(os.environ.get("CHAT_FLUSH_INTERVAL", "0.5"))
+CHAT_FLUSH_BATCH = int(os.environ.get("CHAT_FLUSH_BATCH", "200"))
+CHAT_JOURNAL_SIZE = int(os.environ.get("CHAT_JOURNAL_SIZE", "10000"))
+
+
+async def on_chat_messages_saved(rows: List[Dict]):
+    # id появляются только после записи — тогда же сообщения попадают в историю
+    await backplane.publish("chat_saved", {"messages": [chat_message_out(r) for r in rows]})
+
+
+async def on_chat_saved_message(msg: Dict):
+    if recent_messages.loaded:
+        for m in msg["messages"]:
+            recent_messages.add(m)
+
+
+backplane.subscribe("chat_saved", on_chat_saved_message)
+
+chat_journal = ChatJournal(
+    CHAT_JOURNAL_SIZE,
+    CHAT_FLUSH_BATCH,
+    CHAT_FLUSH_INTERVAL,
+    write=save_public_messages,
+    on_saved=on_chat_messages_saved,
+)
+
+
+async def ensure_recent_messages():
+    if recent_messages.loaded:
+        return
+    async with recent_messages_lock:
+        if recent_messages.loaded:
+            return
+        rows = await get_public_messages(limit=CHAT_HISTORY_SIZE)
+        recent_messages.load_rows(
+            [chat_message_out(r) for r in rows],
+            complete=len(rows) < CHAT_HISTORY_SIZE,
+        )
+
 
 @app.get("/api/public_chat")
-async def api_public_chat():
-    msgs = get_public_messages(limit=200)
+async def api_public_chat(request: Request):
+    # /api/public_chat?limit=50[&before=<id>|&after=<id>] — от новых к старым
+    params = request.query_params
+    limit = parse_int(params.get("limit", CHAT_PAGE_LIMIT))
+    before = parse_int(params.get("before"))
+    after = parse_int(params.get("after"))
+    if (
+        limit is None or limit <= 0
+        or (params.get("before") is not None and before is None)
+        or (params.get("after") is not None and after is None)
+    ):
+        return JSONResponse({"error": "bad_cursor"}, status_code=400)
+    limit = min(limit, CHAT_PAGE_MAX)
+
+    await ensure_recent_messages()
+    page = recent_messages.page(limit, before=before, after=after)
+    if page is None:
+        rows = await get_public_messages(limit=limit, before_id=before, after_id=after)
+        page = [chat_message_out(r) for r in rows]
+
     return {
-        "messages": [
-            {"username": m["username"], "text": m["text"]}
-            for m in msgs
-        ]
+        "messages": page,
+        "next_before": page[-1]["id"] if page else None,
     }
 
 
 # ================== Анонимный чат в боте ==================
 
-waiting_user_id: Optional[int] = None
-pairs: Dict[int, int] = {}
+# Очередь и пары живут в бэкплейне: ключ bot_waiting — кто ждёт собеседника,
+# bot_pair:<id> — с кем сейчас общается пользователь.
+WAITING_KEY = "bot_waiting"
 
 
-def get_partner(user_id: int) -> Optional[int]:
-    return pairs.get(user_id)
+async def get_partner(user_id: int) -> Optional[int]:
+    return await backplane.get(f"bot_pair:{user_id}")
 
 
-def break_pair(user_id: int) -> None:
-    partner = pairs.pop(user_id, None)
+async def break_pair(user_id: int) -> None:
+    partner = await backplane.pop(f"bot_pair:{user_id}")
     if partner is not None:
-        pairs.pop(partner, None)
+        await backplane.cas(f"bot_pair:{partner}", user_id, None)
 
 
-def set_pair(user1: int, user2: int) -> None:
-    pairs[user1] = user2
-    pairs[user2] = user1
+async def set_pair(user1: int, user2: int) -> None:
+    await backplane.set(f"bot_pair:{user1}", user2)
+    await backplane.set(f"bot_pair:{user2}", user1)
 
 
 def build_chat_menu_keyboard() -> InlineKeyboardBuilder:
@@ -250,23 +760,23 @@ async def cmd_chat_menu(message: Message):
 
 @router.callback_query(F.data == "chat_find")
 async def cb_chat_find(callback: CallbackQuery):
-    global waiting_user_id
-
     user_id = callback.from_user.id
 
-    if user_id in pairs:
+    if await get_partner(user_id) is not None:
         await callback.answer("Ты уже общаешься с собеседником.", show_alert=True)
         return
 
+    waiting_user_id = await backplane.get(WAITING_KEY)
+
     if waiting_user_id == user_id:
         await callback.answer("Ты уже в очереди, ждём собеседника…", show_alert=False)
         return
 
-    if waiting_user_id is not None and waiting_user_id != user_id:
+    # забираем ждущего атомарно: два узла не должны сосватать его дважды
+    if waiting_user_id is not None and await backplane.cas(WAITING_KEY, waiting_user_id, None):
         partner_id = waiting_user_id
-        waiting_user_id = None
 
-        set_pair(user_id, partner_id)
+        await set_pair(user_id, partner_id)
 
         try:
             await bot.send_message(
@@ -274,7 +784,7 @@ async def cb_chat_find(callback: CallbackQuery):
                 "🎭 Собеседник найден! Можешь писать, сообщения будут пересылаться анонимно.",
             )
         except Exception:
-            break_pair(user_id)
+            await break_pair(user_id)
             await callback.answer(
                 "Не удалось соединить с собеседником, попробуй ещё раз.",
                 show_alert=True,
@@ -287,25 +797,23 @@ async def cb_chat_find(callback: CallbackQuery):
         await callback.answer()
         return
 
-    waiting_user_id = user_id
+    await backplane.set(WAITING_KEY, user_id)
     await callback.message.answer("⌛ Ты добавлен в очередь. Ждём второго собеседника…")
     await callback.answer()
 
 
 @router.callback_query(F.data == "chat_stop")
 async def cb_chat_stop(callback: CallbackQuery):
-    global waiting_user_id
     user_id = callback.from_user.id
 
-    if waiting_user_id == user_id:
-        waiting_user_id = None
+    if await backplane.cas(WAITING_KEY, user_id, None):
         await callback.message.answer("⛔ Поиск остановлен, ты больше не в очереди.")
         await callback.answer()
         return
 
-    partner = get_partner(user_id)
+    partner = await get_partner(user_id)
     if partner:
-        break_pair(user_id)
+        await break_pair(user_id)
         try:
             await bot.send_message(partner, "❌ Собеседник завершил диалог.")
         except Exception:
@@ -317,55 +825,203 @@ async def cb_chat_stop(callback: CallbackQuery):
     await callback.answer("Ты сейчас ни с кем не общаешься.", show_alert=True)
 
 
+async def send_stars_sync(conn: ClientConnection, since_raw, epoch: Optional[str]):
+    since = parse_int(since_raw)
+    if since is None:
+        return
+    await ensure_stars_snapshot()
+    tiles = ws_manager.view.view_of(conn)
+    await conn.send_json({"type": "stars_sync", **stars_delta(since, epoch, tiles)})
+
+
+async def set_stars_view(conn: ClientConnection, data: dict):
+    # {"type": "viewport", "tiles": [...]} / {"rect": [...]}; без обоих — снова всё небо
+    tiles = None
+    if data.get("tiles") is not None or data.get("rect") is not None:
+        tiles = parse_view(data.get("tiles"), data.get("rect"))
+        if tiles is None:
+            return
+
+    previous = ws_manager.view.view_of(conn)
+    ws_manager.view.set_view(conn, tiles)
+    current = ws_manager.view.view_of(conn)
+    if previous is None:
+        # до этого клиент получал всё небо, догонять нечего
+        return
+
+    # по тайлам, которые только что попали в окно, изменения не приходили
+    await ensure_stars_snapshot()
+    if current is None:
+        delta = stars_delta(0, None)
+    else:
+        added = current - previous
+        if not added:
+            return
+        delta = stars_delta(0, None, added)
+    await conn.send_json({"type": "stars_sync", **delta})
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await ws_manager.connect(websocket)
+    conn = await ws_manager.connect(websocket)
     try:
+        # /ws?since=N&epoch=E — сразу догоняем изменения, пропущенные за время разрыва
+        await send_stars_sync(
+            conn,
+            websocket.query_params.get("since"),
+            websocket.query_params.get("epoch"),
+        )
         while True:
-            await websocket.receive_text()
+            raw = await websocket.receive_text()
+            try:
+                data = json.loads(raw)
+            except Exception:
+                continue
+            if not isinstance(data, dict):
+                continue
+            if data.get("type") == "resume":
+                await send_stars_sync(conn, data.get("since"), data.get("epoch"))
+            elif data.get("type") == "viewport":
+                await set_stars_view(conn, data)
     except WebSocketDisconnect:
-        ws_manager.disconnect(websocket)
+        pass
+    except Exception as e:
+        print(f"WebSocket error: {e}")
+    finally:
+        ws_manager.disconnect(conn)
 
 
 # ================== Чат на сайте (WS) - ИСПРАВЛЕНО ==================
 
+# сколько ждём после закрытия последней вкладки, прежде чем разорвать приватный чат
+CHAT_PRESENCE_GRACE = float(os.environ.get("CHAT_PRESENCE_GRACE", "2"))
+
+
 class SiteChatManager:
+    # Сокеты у каждого узла свои. Кто на каком узле онлайн (chat_online:<id>)
+    # и пары приватного чата (chat_pair:<id>) лежат в бэкплейне; публичные
+    # сообщения идут по каналу "chat", адресные — по "chat_user", и доставляет
+    # их тот узел, у которого открыт сокет получателя.
+    # Локально два индекса: пользователь → его сокеты (несколько вкладок)
+    # и сокет → пользователь, так что connect/disconnect стоят O(1).
+
     def __init__(self):
-        self.broadcast_clients: List[WebSocket] = []
-        self.user_sockets: Dict[int, WebSocket] = {}
-        self.private_pairs: Dict[int, int] = {}
-
-    async def connect(self, ws: WebSocket):
-        await ws.accept()
-        self.broadcast_clients.append(ws)
-
-    def disconnect(self, ws: WebSocket):
-        if ws in self.broadcast_clients:
-            self.broadcast_clients.remove(ws)
-
-        to_remove = []
-        for uid, sock in self.user_sockets.items():
-            if sock is ws:
-                to_remove.append(uid)
-        for uid in to_remove:
-            self.user_sockets.pop(uid, None)
-            partner = self.private_pairs.pop(uid, None)
-            if partner is not None:
-                self.private_pairs.pop(partner, None)
-
-    def bind_user_socket(self, user_id: int, ws: WebSocket):
-        self.user_sockets[user_id] = ws
-
-    async def handle_public_message(self, ws: WebSocket, text: str, user_id: int):
-        ensure_user_cached(user_id)
-        u = users.get(user_id)
-        if not u:
+        self.broadcast_clients: Set[ClientConnection] = set()
+        self.user_sockets: Dict[int, Set[ClientConnection]] = {}
+        self.socket_user: Dict[ClientConnection, int] = {}
+        # отложенные forget_user: держим ссылки, чтобы задачу не собрал GC,
+        # и отменяем, если пользователь вернулся за время паузы
+        self._forget_tasks: Dict[int, asyncio.Task] = {}
+
+    async def connect(self, websocket: WebSocket) -> ClientConnection:
+        await websocket.accept()
+        conn = ClientConnection(websocket, on_close=self.disconnect)
+        self.broadcast_clients.add(conn)
+        return conn
+
+    def disconnect(self, ws: ClientConnection):
+        self.broadcast_clients.discard(ws)
+        ws.close()
+
+        user_id = self._unbind(ws)
+        if user_id is not None and user_id not in self.user_sockets:
+            # закрылась последняя вкладка пользователя на этом узле
+            self._schedule_forget(user_id)
+
+    def _schedule_forget(self, user_id: int):
+        self._cancel_forget(user_id)
+        task = asyncio.create_task(self.forget_user(user_id))
+        self._forget_tasks[user_id] = task
+        task.add_done_callback(lambda t: self._forget_done(user_id, t))
+
+    def _cancel_forget(self, user_id: int):
+        task = self._forget_tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    def _forget_done(self, user_id: int, task: asyncio.Task):
+        if self._forget_tasks.get(user_id) is task:
+            del self._forget_tasks[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            print("DEBUG chat forget_user error:", task.exception())
+
+    def _unbind(self, ws: ClientConnection) -> Optional[int]:
+        user_id = self.socket_user.pop(ws, None)
+        if user_id is None:
+            return None
+        sockets = self.user_sockets.get(user_id)
+        if sockets is not None:
+            sockets.discard(ws)
+            if not sockets:
+                del self.user_sockets[user_id]
+        return user_id
+
+    async def forget_user(self, user_id: int):
+        if not await backplane.cas(f"chat_online:{user_id}", backplane.node_id, None):
+            return
+        # На других узлах у пользователя могли остаться вкладки — пусть отметятся.
+        # Пауза заодно переживает перезагрузку страницы: вернулся — пара цела.
+        await backplane.publish("chat_presence", {"user_id": user_id})
+        await asyncio.sleep(CHAT_PRESENCE_GRACE)
+        if await self.is_online(user_id):
             return
 
-        username = u["username"]
+        partner = await backplane.pop(f"chat_pair:{user_id}")
+        if partner is not None and await backplane.cas(f"chat_pair:{partner}", user_id, None):
+            u = users.peek(user_id)
+            await self.send_to_user(partner, {
+                "type": "private_end",
+                "partner_id": user_id,
+                "message": f"@{u.username if u else 'собеседник'} вышел, приватный чат завершён.",
+            })
+
+    async def on_presence_check(self, msg: dict):
+        user_id = msg["user_id"]
+        if user_id in self.user_sockets:
+            await backplane.set(f"chat_online:{user_id}", backplane.node_id)
 
-        # Сохраняем в БД
-        save_public_message(user_id, username, text)
+    async def bind_user_socket(self, user_id: int, ws: ClientConnection):
+        if self.socket_user.get(ws) == user_id:
+            return
+        previous = self._unbind(ws)
+        if previous is not None and previous not in self.user_sockets:
+            self._schedule_forget(previous)
+        self._cancel_forget(user_id)
+        self.socket_user[ws] = user_id
+        self.user_sockets.setdefault(user_id, set()).add(ws)
+        await backplane.set(f"chat_online:{user_id}", backplane.node_id)
+
+    async def is_online(self, user_id: int) -> bool:
+        return await backplane.get(f"chat_online:{user_id}") is not None
+
+    async def send_to_user(self, user_id: int, data: dict):
+        await backplane.publish("chat_user", {"user_id": user_id, "data": data})
+
+    async def on_user_message(self, msg: dict):
+        sockets = self.user_sockets.get(msg["user_id"])
+        if sockets:
+            broadcast_json(sockets, msg["data"])
+
+    async def on_public_message(self, msg: dict):
+        # JSON один раз, дальше — очереди клиентов этого узла
+        broadcast_json(self.broadcast_clients, msg)
+
+    async def handle_public_message(self, ws: ClientConnection, text: str, u: StarUser):
+        username = u.username
+
+        # В журнал на запись в БД; сама запись — в фоне, после рассылки
+        accepted = chat_journal.append({
+            "user_id": u.id,
+            "username": username,
+            "text": text,
+            "created_at": datetime.now(),
+        })
+        if not accepted:
+            await ws.send_json({
+                "type": "system",
+                "message": "Чат перегружен, сообщение не отправлено. Попробуй чуть позже.",
+            })
+            return
 
         # Отправляем ВСЕМ клиентам чата
         message_data = {
@@ -374,86 +1030,64 @@ class SiteChatManager:
             "text": text
         }
         
-        # Отправляем всем подключенным клиентам
-        for client in list(self.broadcast_clients):
-            try:
-                await client.send_json(message_data)
-            except Exception:
-                try:
-                    self.broadcast_clients.remove(client)
-                except ValueError:
-                    pass
+        # Отправляем всем подключенным клиентам на всех узлах
+        await backplane.publish("chat", message_data)
 
         # Обновляем активность пользователя
         set_last_active(u)
         inc_activity(u, 2.0)
-        sync_star_state_to_db(user_id)
+        mark_star_dirty(u.id)
         
         # Обновляем звезду на небе
-        await ws_manager.broadcast_json({
-            "type": "activity_update",
-            "id": user_id,
-            "username": username,
-            "active": True,
-            "activity_score": float(u.get("activity_score", 0.0)),
-            "star_color": u.get("star_color") or "#ffffff",
-            "star_shape": u.get("star_shape") or "circle",
-        })
+        await publish_star(u)
 
     async def handle_private_request(
         self,
-        ws: WebSocket,
-        from_id: int,
+        ws: ClientConnection,
+        u: StarUser,
         to_id: int,
     ):
-        target_ws = self.user_sockets.get(to_id)
-        if not target_ws:
+        if not await self.is_online(to_id):
             await ws.send_json({
                 "type": "system",
                 "message": "Пользователь не в чате.",
             })
             return
 
-        await target_ws.send_json({
+        await self.send_to_user(to_id, {
             "type": "private_request",
-            "from_id": from_id,
-            "from_username": users.get(from_id, {}).get("username", "пользователь"),
+            "from_id": u.id,
+            "from_username": u.username,
             "to_id": to_id,
         })
 
     async def handle_private_response(
         self,
-        ws: WebSocket,
+        ws: ClientConnection,
         accepted: bool,
-        from_id: int,
-        to_id_raw,
+        u: StarUser,
+        to_id: int,
     ):
-        try:
-            to_id = int(to_id_raw)
-        except Exception:
-            return
-
-        target_ws = self.user_sockets.get(to_id)
-        if not target_ws:
+        if not await self.is_online(to_id):
             return
 
-        await target_ws.send_json({
+        await self.send_to_user(to_id, {
             "type": "private_response",
             "accepted": accepted,
-            "from_id": from_id,
-            "from_username": users.get(from_id, {}).get("username", "пользователь"),
+            "from_id": u.id,
+            "from_username": u.username,
             "to_id": to_id,
         })
 
         if accepted:
-            self.private_pairs[from_id] = to_id
-            self.private_pairs[to_id] = from_id
+            await backplane.set(f"chat_pair:{u.id}", to_id)
+            await backplane.set(f"chat_pair:{to_id}", u.id)
 
     async def handle_private_message(
         self,
-        ws: WebSocket,
+        ws: ClientConnection,
         text: str,
-        user_id: int,
+        u: StarUser,
         partner_id: Optional[int],
     ):
         if partner_id is None:
@@ -463,257 +1097,285 @@ class SiteChatManager:
             })
             return
 
-        ensure_user_cached(user_id)
-        ensure_user_cached(partner_id)
-
         # Проверяем, есть ли пара
-        if self.private_pairs.get(user_id) != partner_id:
+        if await backplane.get(f"chat_pair:{u.id}") != partner_id:
             await ws.send_json({
                 "type": "system",
                 "message": "Приватный чат ещё не подтверждён или уже завершён.",
             })
             return
 
-        partner_ws = self.user_sockets.get(partner_id)
-        if not partner_ws:
+        if not await self.is_online(partner_id):
             await ws.send_json({
                 "type": "system",
                 "message": "Собеседник вышел из чата.",
             })
             return
 
-        u = users[user_id]
-        username = u["username"]
-
         # Отправляем сообщение собеседнику
-        await partner_ws.send_json({
+        await self.send_to_user(partner_id, {
             "type": "private",
-            "from_id": user_id,
+            "from_id": u.id,
             "to_id": partner_id,
-            "username": username,
+            "username": u.username,
             "text": text,
         })
 
         # Обновляем активность
         set_last_active(u)
         inc_activity(u, 3.0)
-        sync_star_state_to_db(user_id)
+        mark_star_dirty(u.id)
         
         # Обновляем звезду
-        await ws_manager.broadcast_json({
-            "type": "activity_update",
-            "id": user_id,
-            "username": username,
-            "active": True,
-            "activity_score": float(u.get("activity_score", 0.0)),
-            "star_color": u.get("star_color") or "#ffffff",
-            "star_shape": u.get("star_shape") or "circle",
-        })
+        await publish_star(u)
 
 
 site_chat_manager = SiteChatManager()
+backplane.subscribe("chat", site_chat_manager.on_public_message)
+backplane.subscribe("chat_user", site_chat_manager.on_user_message)
+backplane.subscribe("chat_presence", site_chat_manager.on_presence_check)
 
 
-@app.websocket("/ws_chat")
-async def ws_chat(websocket: WebSocket):
-    await site_chat_manager.connect(websocket)
-    user_id = None
-    
-    try:
-        while True:
-            data = await websocket.receive_json()
-            
-            # Отправляем приветственное сообщение при подключении
-            if not hasattr(websocket, "welcomed"):
-                await websocket.send_json({
-                    "type": "system",
-                    "message": "✅ Подключение к чату установлено"
-                })
-                websocket.welcomed = True
-
-            msg_type = data.get("type")
-            text = (data.get("text") or "").strip()
-            user_id_raw = data.get("user_id")
+# ====== Сессия чата ======
+# Сокет авторизуется один раз: кадром {"type": "hello", "token": ...} или
+# /ws_chat?token=... (токен выдаёт /api/login). Дальше сессия держит готовую
+# запись пользователя, а кадры разбираются по таблице CHAT_HANDLERS.
 
-            try:
-                user_id = int(user_id_raw) if user_id_raw is not None else None
-            except Exception:
-                user_id = None
-
-            if user_id is not None:
-                site_chat_manager.bind_user_socket(user_id, websocket)
-                ensure_user_cached(user_id)
-
-            if msg_type == "private_request":
-                if user_id is not None:
-                    to_id_raw = data.get("to_id")
-                    try:
-                        to_id = int(to_id_raw)
-                    except Exception:
-                        to_id = None
-                    if to_id is not None:
-                        await site_chat_manager.handle_private_request(
-                            websocket,
-                            from_id=user_id,
-                            to_id=to_id,
-                        )
-                continue
+class ChatSession:
+    __slots__ = ("conn", "user")
 
-            if msg_type == "private_response":
-                if user_id is not None:
-                    await site_chat_manager.handle_private_response(
-                        websocket,
-                        accepted=bool(data.get("accepted")),
-                        from_id=user_id,
-                        to_id_raw=data.get("to_id"),
-                    )
-                continue
+    def __init__(self, conn: ClientConnection):
+        self.conn = conn
+        self.user: Optional[StarUser] = None
 
-            if msg_type != "message":
-                continue
-                
-            if not text:
-                continue
+    async def current_user(self) -> Optional[StarUser]:
+        u = self.user
+        if u is None:
+            return None
+        # запись могли вытеснить из кэша — тогда берём актуальную
+        if users.peek(u.id) is not u:
+            u = self.user = await ensure_user_cached(u.id)
+        return u
 
-            if user_id is None:
-                await websocket.send_json({
-                    "type": "system",
-                    "message": "Чтобы писать в чат, войди через код из бота."
-                })
-                continue
 
-            ensure_user_cached(user_id)
-            if user_id not in users:
-                await websocket.send_json({
-                    "type": "system",
-                    "message": "Чтобы писать в чат, зайди через бота и появись на небе."
-                })
-                continue
+async def send_rate_limited(session: ChatSession):
+    await session.conn.send_json({
+        "type": "system",
+        "message": "Слишком часто, подожди немного."
+    })
 
-            mode = data.get("mode")
-            if mode == "public":
-                await site_chat_manager.handle_public_message(websocket, text, user_id)
-            else:
-                partner_id_raw = data.get("partner_id")
-                try:
-                    partner_id = int(partner_id_raw) if partner_id_raw is not None else None
-                except Exception:
-                    partner_id = None
-                await site_chat_manager.handle_private_message(
-                    websocket, text, user_id, partner_id
-                )
 
-    except WebSocketDisconnect:
-        print(f"WebSocket disconnected: {user_id}")
-        site_chat_manager.disconnect(websocket)
-    except Exception as e:
-        print(f"WebSocket error: {e}")
-        site_chat_manager.disconnect(websocket)
+async def chat_hello(session: ChatSession, data: dict):
+    user_id = verify_session_token(data.get("token"))
+    if user_id is None:
+        await session.conn.send_json({
+            "type": "system",
+            "message": "Сессия устарела, войди заново через код из бота."
+        })
+        return
 
+    u = await ensure_user_cached(user_id)
+    if not u:
+        await session.conn.send_json({
+            "type": "system",
+            "message": "Чтобы писать в чат, зайди через бота и появись на небе."
+        })
+        return
 
-# ================== API: звёзды, логин, скины, info ==================
+    session.user = u
+    await site_chat_manager.bind_user_socket(u.id, session.conn)
 
-@app.get("/api/stars")
-async def get_stars():
-    star_rows = get_all_star_states()
-    db_users = get_all_users_from_db()
-    db_by_id = {row["telegram_id"]: row for row in db_users}
 
-    result = []
+async def chat_private_request(session: ChatSession, data: dict):
+    u = await session.current_user()
+    to_id = parse_int(data.get("to_id"))
+    if u and to_id is not None:
+        if not chat_request_limit.allow(u.id):
+            await send_rate_limited(session)
+            return
+        await site_chat_manager.handle_private_request(session.conn, u, to_id)
 
-    for row in star_rows:
-        tg_id = row["user_id"]
-        db_row = db_by_id.get(tg_id)
-        local = users.get(tg_id, {})
 
-        username = (
-            local.get("username")
-            or (db_row["username"] if db_row else None)
-            or f"user_{tg_id}"
+async def chat_private_response(session: ChatSession, data: dict):
+    u = await session.current_user()
+    to_id = parse_int(data.get("to_id"))
+    if u and to_id is not None:
+        await site_chat_manager.handle_private_response(
+            session.conn, bool(data.get("accepted")), u, to_id
         )
-        full_name = local.get("full_name", username)
 
-        if row.get("info"):
-            info = row["info"]
-        elif db_row and db_row.get("info"):
-            info = db_row["info"]
-        else:
-            info = local.get("info") or f"{full_name} уже на небе"
 
-        active_flag = tg_id in users and is_active(users[tg_id])
+async def chat_message(session: ChatSession, data: dict):
+    text = (data.get("text") or "").strip()
+    if not text:
+        return
 
-        result.append(
-            {
-                "id": tg_id,
-                "username": username,
-                "info": info,
-                "active": active_flag,
-                "activity_score": float(row.get("activity_score", 0.0)),
-                "star_color": row.get("star_color") or "#ffffff",
-                "star_shape": row.get("star_shape") or "circle",
-            }
+    u = await session.current_user()
+    if not u:
+        await session.conn.send_json({
+            "type": "system",
+            "message": "Чтобы писать в чат, войди через код из бота."
+        })
+        return
+
+    if not chat_message_limit.allow(u.id):
+        await send_rate_limited(session)
+        return
+
+    if data.get("mode") == "public":
+        await site_chat_manager.handle_public_message(session.conn, text, u)
+    else:
+        await site_chat_manager.handle_private_message(
+            session.conn, text, u, parse_int(data.get("partner_id"))
         )
 
-    return JSONResponse(result)
+
+CHAT_HANDLERS = {
+    "hello": chat_hello,
+    "private_request": chat_private_request,
+    "private_response": chat_private_response,
+    "message": chat_message,
+}
+
+
+@app.websocket("/ws_chat")
+async def ws_chat(websocket: WebSocket):
+    conn = await site_chat_manager.connect(websocket)
+    session = ChatSession(conn)
+
+    await conn.send_json({
+        "type": "system",
+        "message": "✅ Подключение к чату установлено"
+    })
+
+    try:
+        token = websocket.query_params.get("token")
+        if token:
+            await chat_hello(session, {"token": token})
+
+        while True:
+            data = await websocket.receive_json()
+            if not isinstance(data, dict):
+                continue
+            # флуд с одного сокета молча отбрасываем, не разбирая кадр
+            if not chat_socket_limit.allow(conn):
+                continue
+            handler = CHAT_HANDLERS.get(data.get("type"))
+            if handler:
+                await handler(session, data)
+
+    except WebSocketDisconnect:
+        print(f"WebSocket disconnected: {session.user.id if session.user else None}")
+    except Exception as e:
+        print(f"WebSocket error: {e}")
+    finally:
+        site_chat_manager.disconnect(conn)
+        chat_socket_limit.forget(conn)
+
+
+# ================== API: звёзды, логин, скины, info ==================
+
+@app.get("/api/stars")
+async def get_stars(request: Request):
+    await ensure_stars_snapshot()
+
+    # ?tile=3:5,4:5 или ?rect=x0,y0,x1,y1 — только звёзды этого куска неба
+    tiles = None
+    tiles_raw = request.query_params.get("tile")
+    rect_raw = request.query_params.get("rect")
+    if tiles_raw is not None or rect_raw is not None:
+        tiles = parse_view(tiles_raw, rect_raw)
+        if tiles is None:
+            return JSONResponse({"ok": False, "error": "bad_tile"}, status_code=400)
+
+    # ?since=N — только звёзды, изменившиеся после seq N
+    since_raw = request.query_params.get("since")
+    if since_raw is not None or tiles is not None:
+        since = parse_int(since_raw) if since_raw is not None else 0
+        if since is None or since < 0:
+            return JSONResponse({"ok": False, "error": "bad_since"}, status_code=400)
+        return JSONResponse(stars_delta(since, request.query_params.get("epoch"), tiles))
+
+    body, etag = stars_snapshot.render()
+
+    # no-cache: браузер всегда переспрашивает, но при совпадении ETag получает пустой 304
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+LEADERBOARD_DEFAULT_K = 10
+LEADERBOARD_MAX_K = 100
+
+
+@app.get("/api/stars/top")
+async def get_top_stars(request: Request):
+    # самые яркие звёзды из рейтинга снапшота, без сортировки всего неба
+    await ensure_stars_snapshot()
+
+    k = parse_int(request.query_params.get("k", LEADERBOARD_DEFAULT_K))
+    if k is None or k <= 0:
+        return JSONResponse({"ok": False, "error": "bad_k"}, status_code=400)
+    k = min(k, LEADERBOARD_MAX_K)
+
+    leaders = stars_snapshot.leaders
+    now = time.time()
+    stars = [
+        {"rank": rank, **stars_snapshot.stars[star_id], "activity_now": leaders.score(star_id, now)}
+        for rank, star_id in enumerate(leaders.top(k), start=1)
+    ]
+    return {"ok": True, "total": len(leaders), "stars": stars}
+
+
+@app.get("/api/stars/{user_id}/rank")
+async def get_star_rank(user_id: int):
+    await ensure_stars_snapshot()
+    if user_id not in stars_snapshot.stars:
+        return JSONResponse({"ok": False, "error": "user_not_found"}, status_code=404)
+    return {
+        "ok": True,
+        "total": len(stars_snapshot.leaders),
+        "star": {
+            "rank": stars_snapshot.leaders.rank(user_id),
+            **stars_snapshot.stars[user_id],
+            "activity_now": stars_snapshot.leaders.score(user_id),
+        },
+    }
 
 
 @app.post("/api/login")
 async def api_login(request: Request):
+    if not login_limit.allow(client_ip(request)):
+        return rate_limited_response()
+
     data = await request.json()
     code = (data.get("code") or "").strip().upper()
     if not code:
         return JSONResponse({"ok": False, "error": "empty_code"}, status_code=400)
 
-    conn = get_connection()
-    try:
-        cur = conn.cursor(dictionary=True)
-        cur.execute(
-            """
-            SELECT u.telegram_id AS id,
-                   u.username,
-                   u.info,
-                   s.activity_score,
-                   s.star_color,
-                   s.star_shape,
-                   s.skins_owned
-            FROM users u
-            LEFT JOIN user_stars s ON s.user_id = u.telegram_id
-            WHERE u.login_code = %s
-            """,
-            (code,)
-        )
-        row = cur.fetchone()
-    finally:
-        cur.close()
-        conn.close()
-
-    if not row:
+    user_id = await consume_login_code(code)
+    if user_id is None:
         return JSONResponse({"ok": False, "error": "invalid_code"}, status_code=404)
 
-    set_login_code(row["id"], None)
-
-    skins = []
-    skins_raw = row.get("skins_owned")
-    if isinstance(skins_raw, str):
-        try:
-            skins = json.loads(skins_raw)
-        except Exception:
-            skins = []
-    elif isinstance(skins_raw, list):
-        skins = skins_raw
+    # из кэша или одним запросом users + user_stars
+    u = await ensure_user_cached(user_id)
+    if not u:
+        return JSONResponse({"ok": False, "error": "invalid_code"}, status_code=404)
 
     return {
         "ok": True,
         "user": {
-            "id": row["id"],
-            "username": row["username"],
-            "full_name": row["username"],
-            "activity_score": float(row.get("activity_score") or 0.0),
-            "star_color": row.get("star_color") or "#ffffff",
-            "star_shape": row.get("star_shape") or "circle",
-            "skins_owned": skins,
-            "info": row.get("info") or "",
+            "id": u.id,
+            "username": u.username,
+            "full_name": u.username,
+            "activity_score": get_activity(u),
+            "star_color": u.star_color,
+            "star_shape": u.star_shape,
+            "skins_owned": list(u.skins_owned),
+            "info": u.info or "",
         },
+        "session_token": issue_session_token(u.id),
     }
 
 
@@ -730,6 +1392,78 @@ STAR_SKINS = {
 }
 
 
+# ================== Коды входа ==================
+
+# Код из /login живёт в бэкплейне (login_code:<код> → id пользователя)
+# LOGIN_CODE_TTL секунд и гасится первым же входом: pop атомарен, так что
+# один код — один вход. Неверные коды отсекаются без единого запроса в MySQL.
+LOGIN_CODE_TTL = float(os.environ.get("LOGIN_CODE_TTL", "600"))
+
+
+# Токен сессии чата: "<id>.<истекает>.<подпись>". Подпись HMAC-SHA256 на
+# секрете CHAT_SESSION_SECRET. Выводить его из чего-то лежащего в репозитории
+# нельзя — тогда токен подделает кто угодно. Все процессы сайта должны делить
+# один секрет, поэтому с общим бэкплейном его обязательно задают явно (см. role_error);
+# одиночный процесс без него берёт случайный, и после перезапуска вход просто
+# понадобится заново.
+CHAT_SESSION_SECRET_SET = bool(os.environ.get("CHAT_SESSION_SECRET"))
+CHAT_SESSION_SECRET = os.environ.get("CHAT_SESSION_SECRET", "").encode() or secrets.token_bytes(32)
+CHAT_SESSION_TTL = int(os.environ.get("CHAT_SESSION_TTL", str(24 * 3600)))
+
+
+def _sign_session(payload: str) -> str:
+    return hmac.new(CHAT_SESSION_SECRET, payload.encode(), hashlib.sha256).hexdigest()
+
+
+def issue_session_token(user_id: int) -> str:
+    payload = f"{user_id}.{int(time.time()) + CHAT_SESSION_TTL}"
+    return f"{payload}.{_sign_session(payload)}"
+
+
+def verify_session_token(token) -> Optional[int]:
+    if not isinstance(token, str) or token.count(".") != 2:
+        return None
+    payload, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(_sign_session(payload), signature):
+        return None
+    user_id, expires = payload.split(".")
+    try:
+        if int(expires) < time.time():
+            return None
+        return int(user_id)
+    except ValueError:
+        return None
+
+
+def request_session_user(request: Request, data: dict) -> Optional[int]:
+    # Пользователь запроса — только из токена сессии (Authorization: Bearer ...
+    # или поле session_token), а не из присланного user_id
+    auth = request.headers.get("authorization", "")
+    token = auth[7:] if auth.lower().startswith("bearer ") else data.get("session_token")
+    return verify_session_token(token)
+
+
+async def issue_login_code(user_id: int) -> str:
+    # у пользователя один живой код: новый /login отменяет прежний
+    old = await backplane.pop(f"login_code_of:{user_id}")
+    if old is not None:
+        await backplane.cas(f"login_code:{old}", user_id, None)
+
+    code = generate_login_code()
+    await backplane.set(f"login_code:{code}", user_id, ttl=LOGIN_CODE_TTL)
+    await backplane.set(f"login_code_of:{user_id}", code, ttl=LOGIN_CODE_TTL)
+    return code
+
+
+async def consume_login_code(code: str) -> Optional[int]:
+    if len(code) != LOGIN_CODE_LENGTH or not LOGIN_CODE_CHARS.issuperset(code):
+        return None
+    user_id = await backplane.pop(f"login_code:{code}")
+    if user_id is not None:
+        await backplane.cas(f"login_code_of:{user_id}", code, None)
+    return user_id
+
+
 @app.get("/api/skins")
 async def api_skins():
     return {
@@ -749,67 +1483,57 @@ async def api_skins():
 @app.post("/api/buy_skin")
 async def api_buy_skin(request: Request):
     data = await request.json()
-    user_id = data.get("user_id")
+    user_id = request_session_user(request, data)
     skin_id = data.get("skin_id")
 
-    if user_id is None or skin_id not in STAR_SKINS:
+    if user_id is None:
+        return JSONResponse({"ok": False, "error": "no_session"}, status_code=401)
+
+    if skin_id not in STAR_SKINS:
         return JSONResponse({"ok": False, "error": "bad_request"}, status_code=400)
 
-    try:
-        user_id = int(user_id)
-    except Exception:
-        return JSONResponse({"ok": False, "error": "bad_user_id"}, status_code=400)
+    if not api_write_limit.allow(user_id):
+        return rate_limited_response()
 
-    ensure_user_cached(user_id)
-    user = users.get(user_id)
+    user = await ensure_user_cached(user_id)
     if not user:
         return JSONResponse({"ok": False, "error": "user_not_found"}, status_code=404)
 
-    user.setdefault("skins_owned", [])
-
     skin = STAR_SKINS[skin_id]
     cost = skin["cost"]
     skin_type = skin["type"]
 
-    if skin_id in user["skins_owned"]:
+    if skin_id in user.skins_owned:
         if skin_type in ("both", "color") and skin["color"]:
-            user["star_color"] = skin["color"]
+            user.star_color = skin["color"]
         if skin_type in ("both", "shape") and skin["shape"]:
-            user["star_shape"] = skin["shape"]
-        sync_star_state_to_db(user_id)
+            user.star_shape = skin["shape"]
+        mark_star_dirty(user_id)
     else:
-        if float(user.get("activity_score", 0.0)) < cost:
+        if get_activity(user) < cost:
             return JSONResponse({"ok": False, "error": "not_enough_activity"}, status_code=400)
 
-        user["activity_score"] = float(user.get("activity_score", 0.0)) - cost
-        user["skins_owned"].append(skin_id)
+        inc_activity(user, -cost)
+        user.skins_owned.append(skin_id)
 
         if skin_type in ("both", "color") and skin["color"]:
-            user["star_color"] = skin["color"]
+            user.star_color = skin["color"]
         if skin_type in ("both", "shape") and skin["shape"]:
-            user["star_shape"] = skin["shape"]
-
-        sync_star_state_to_db(user_id)
-
-    await ws_manager.broadcast_json({
-        "type": "activity_update",
-        "id": user["id"],
-        "username": user["username"],
-        "active": True,
-        "activity_score": float(user["activity_score"]),
-        "star_color": user.get("star_color") or "#ffffff",
-        "star_shape": user.get("star_shape") or "circle",
-    })
+            user.star_shape = skin["shape"]
+
+        mark_star_dirty(user_id)
+
+    await publish_star(user)
 
     return {
         "ok": True,
         "user": {
-            "id": user["id"],
-            "username": user["username"],
-            "activity_score": float(user["activity_score"]),
-            "star_color": user.get("star_color") or "#ffffff",
-            "star_shape": user.get("star_shape") or "circle",
-            "skins_owned": user.get("skins_owned", []),
+            "id": user.id,
+            "username": user.username,
+            "activity_score": get_activity(user),
+            "star_color": user.star_color,
+            "star_shape": user.star_shape,
+            "skins_owned": user.skins_owned,
         }
     }
 
@@ -817,27 +1541,26 @@ async def api_buy_skin(request: Request):
 @app.post("/api/update_info")
 async def api_update_info(request: Request):
     data = await request.json()
-    user_id = data.get("user_id")
+    user_id = request_session_user(request, data)
     info = (data.get("info") or "").strip()
 
-    if not user_id:
-        return JSONResponse({"ok": False, "error": "no_user_id"}, status_code=400)
+    if user_id is None:
+        return JSONResponse({"ok": False, "error": "no_session"}, status_code=401)
 
-    try:
-        user_id = int(user_id)
-    except Exception:
-        return JSONResponse({"ok": False, "error": "bad_user_id"}, status_code=400)
+    if not api_write_limit.allow(user_id):
+        return rate_limited_response()
 
-    ensure_user_cached(user_id)
-    if user_id not in users:
+    user = await ensure_user_cached(user_id)
+    if not user:
         return JSONResponse({"ok": False, "error": "user_not_found"}, status_code=404)
 
     if len(info) > 100:
         return JSONResponse({"ok": False, "error": "too_long"}, status_code=400)
 
-    users[user_id]["info"] = info
-    sync_star_state_to_db(user_id)
-    update_info_in_db(user_id, info)
+    user.info = info
+    mark_star_dirty(user_id)
+    await update_info_in_db(user_id, info)
+    await publish_star(user)
 
     return {"ok": True}
 
@@ -852,23 +1575,18 @@ async def cmd_start(message: Message):
     full_name = user.full_name
     is_new = user.id not in users
 
-    ensure_user_cached(user.id)
-    u = users[user.id]
-    u["username"] = username
-    u["full_name"] = full_name
-    u.setdefault("star_color", "#ffffff")
-    u.setdefault("star_shape", "circle")
-    u.setdefault("skins_owned", [])
-    u.setdefault("info", "")
+    u = await ensure_user_cached(user.id, create=True)
+    u.username = username
+    u.full_name = full_name
 
     set_last_active(u)
     inc_activity(u, 3.0)
-    sync_star_state_to_db(user.id)
+    mark_star_dirty(user.id)
 
-    create_or_update_user(
+    await create_or_update_user(
         telegram_id=user.id,
         username=username,
-        info=u.get("info") or ""
+        info=u.info
     )
 
     await message.answer(
@@ -878,30 +1596,24 @@ async def cmd_start(message: Message):
     )
 
     if is_new:
-        data = {
-            "type": "new_star",
-            "id": user.id,
-            "username": username,
-            "info": f"{full_name} только что появился на небе",
-            "active": True,
-            "activity_score": float(u.get("activity_score", 0.0)),
-            "star_color": u.get("star_color") or "#ffffff",
-            "star_shape": u.get("star_shape") or "circle",
-        }
-        await ws_manager.broadcast_json(data)
+        await publish_star(
+            u,
+            "new_star",
+            info=f"{full_name} только что появился на небе",
+        )
+    else:
+        await publish_star(u)
 
 
 @router.message(Command("login"))
 async def cmd_login(message: Message):
     user = message.from_user
-    ensure_user_cached(user.id)
-    info = users.get(user.id)
+    info = await ensure_user_cached(user.id)
     if not info:
         await message.answer("Сначала напиши /start, чтобы появиться на небе.")
         return
 
-    code = generate_login_code()
-    set_login_code(user.id, code)
+    code = await issue_login_code(user.id)
 
     await message.answer(
         "Код для входа на сайт Star Users:\n"
@@ -914,19 +1626,18 @@ async def cmd_login(message: Message):
 @router.message(F.text == "/me")
 async def cmd_me(message: Message):
     user = message.from_user
-    ensure_user_cached(user.id)
-    info = users.get(user.id)
+    info = await ensure_user_cached(user.id)
     if not info:
         await message.answer("Ты ещё не зарегистрирован. Напиши /start")
         return
 
     await message.answer(
-        f"Ты уже на небе как @{info['username']} ✨\n"
-        f"Твой уровень активности: {int(info.get('activity_score', 0))}\n"
-        f"Цвет звезды: {info.get('star_color', '#ffffff')}\n"
-        f"Форма звезды: {info.get('star_shape', 'circle')}\n"
-        f"Купленные скины: {', '.join(info.get('skins_owned', [])) or 'нет'}\n"
-        f"Описание: {info.get('info') or 'не задано'}"
+        f"Ты уже на небе как @{info.username} ✨\n"
+        f"Твой уровень активности: {int(get_activity(info))}\n"
+        f"Цвет звезды: {info.star_color}\n"
+        f"Форма звезды: {info.star_shape}\n"
+        f"Купленные скины: {', '.join(info.skins_owned) or 'нет'}\n"
+        f"Описание: {info.info or 'не задано'}"
     )
 
 
@@ -936,12 +1647,16 @@ async def any_message(message: Message):
     user_id = user.id
     text = message.text or ""
 
-    partner_id = get_partner(user_id)
+    # флуд боту не пересылаем собеседнику и не засчитываем в активность
+    if not bot_message_limit.allow(user_id):
+        return
+
+    partner_id = await get_partner(user_id)
     if partner_id:
         try:
             await bot.send_message(partner_id, f"💬 Собеседник: {text}")
         except Exception:
-            break_pair(user_id)
+            await break_pair(user_id)
             await message.answer(
                 "Не удалось доставить сообщение собеседнику, диалог остановлен."
             )
@@ -949,65 +1664,351 @@ async def any_message(message: Message):
     username = user.username or f"user_{user.id}"
     full_name = user.full_name
 
-    ensure_user_cached(user.id)
-    u = users[user.id]
-    u["username"] = username
-    u["full_name"] = full_name
-    u.setdefault("star_color", "#ffffff")
-    u.setdefault("star_shape", "circle")
-    u.setdefault("skins_owned", [])
-    u.setdefault("info", "")
+    u = await ensure_user_cached(user.id, create=True)
+    u.username = username
+    u.full_name = full_name
 
     set_last_active(u)
     inc_activity(u, 1.0)
-    sync_star_state_to_db(user.id)
-    update_last_activity(user.id)
-
-    data = {
-        "type": "activity_update",
-        "id": user.id,
-        "username": username,
-        "active": True,
-        "activity_score": float(u.get("activity_score", 0.0)),
-        "star_color": u.get("star_color") or "#ffffff",
-        "star_shape": u.get("star_shape") or "circle",
-    }
-    await ws_manager.broadcast_json(data)
+    mark_star_dirty(user.id)
+    await update_last_activity(user.id)
+
+    await publish_star(u)
 
 
 # ================== Служебные циклы и main ==================
 
-async def activity_decay_loop():
+async def active_flag_loop():
+    # Очки затухают сами при чтении (на сервере и у клиентов), их здесь не трогаем.
+    # Публикуем только звёзды, переставшие быть активными: флаг active в БД не хранится.
+    while True:
+        await asyncio.sleep(10)
+
+        for user_id in list(recently_active_ids):
+            u = users.peek(user_id)
+            if not u or not is_active(u):
+                recently_active_ids.discard(user_id)
+                if u and stars_snapshot.update(star_payload(u)):
+                    await publish_star(u)
+
+        users.expire()
+
+
+async def cache_maintenance_loop():
+    # для узлов без планировщика: флаг active гасит он,
+    # а здесь только чистим свой кэш
     while True:
         await asyncio.sleep(10)
-        if users:
-            dec_activity_all(0.5)
+        for user_id in list(recently_active_ids):
+            u = users.peek(user_id)
+            if not u or not is_active(u):
+                recently_active_ids.discard(user_id)
+        users.expire()
+
+
+# Раз в STATS_LOG_INTERVAL секунд процесс печатает свои счётчики (0 — не печатать):
+# ожидание соединений пула БД, попадания и вытеснения кэша пользователей видно
+# только изнутри работающего процесса.
+STATS_LOG_INTERVAL = float(os.environ.get("STATS_LOG_INTERVAL", "300"))
+
+
+def process_stats() -> Dict:
+    return {"db_pool": db_async.pool_stats(), "users_cache": users.stats()}
+
+
+async def stats_log_loop():
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        print("STATS", json.dumps(process_stats(), default=str))
 
 
 async def run_bot():
+    if BOT_MODE == "webhook":
+        await run_bot_webhook()
+        return
+
+    delay = 1
     while True:
         try:
             await dp.start_polling(bot)
+            break
         except TelegramNetworkError as e:
-            print("TelegramNetworkError, retry in 10s:", e)
-            await asyncio.sleep(10)
+            print(f"TelegramNetworkError, retry in {delay}s:", e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
         except Exception as e:
             print("Unexpected error in bot:", e)
             break
 
 
-async def main():
-    bot_task = asyncio.create_task(run_bot())
+# ================== Webhook бота ==================
+
+# Маршрут только кладёт апдейт в очередь и сразу отвечает Telegram.
+# Очередей BOT_WEBHOOK_WORKERS, у каждой свой воркер, и апдейт попадает в очередь
+# по id чата: разные чаты обрабатываются параллельно, а апдейты одного чата —
+# строго по порядку, как при polling (пары анонимного чата, /start до сообщений).
+# Пока пул не запущен (режим polling или процесс без роли bot), маршрут отвечает 404.
+bot_updates: Optional[List[asyncio.Queue]] = None
+webhook_router = APIRouter()
+
+
+def update_chat_id(update: Update) -> int:
+    # чат апдейта; у событий без чата (inline-запросы и т.п.) — пользователь
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return update.update_id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None) or getattr(event, "user", None)
+    return user.id if user is not None else update.update_id
+
+
+@webhook_router.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    if bot_updates is None:
+        return JSONResponse({"ok": False}, status_code=404)
+
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return JSONResponse({"ok": False}, status_code=401)
+
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        print("DEBUG bad webhook update:", e)
+        return JSONResponse({"ok": False}, status_code=400)
+
+    queue = bot_updates[update_chat_id(update) % len(bot_updates)]
+    try:
+        queue.put_nowait(update)
+    except asyncio.QueueFull:
+        # Telegram повторит доставку позже
+        return JSONResponse({"ok": False}, status_code=503)
+
+    return {"ok": True}
+
+
+app.include_router(webhook_router)
+
+
+async def webhook_worker(queue: asyncio.Queue):
+    while True:
+        update = await queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            print("DEBUG webhook update error:", e)
+        finally:
+            queue.task_done()
 
+
+async def run_bot_webhook():
+    global bot_updates
+    shard_size = max(1, BOT_WEBHOOK_QUEUE // BOT_WEBHOOK_WORKERS)
+    bot_updates = [asyncio.Queue(maxsize=shard_size) for _ in range(BOT_WEBHOOK_WORKERS)]
+    workers = [asyncio.create_task(webhook_worker(queue)) for queue in bot_updates]
+
+    try:
+        if WEBHOOK_BASE_URL:
+            await bot.set_webhook(
+                WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        else:
+            print("WEBHOOK_BASE_URL is not set, expecting the webhook to be registered already")
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        bot_updates = None
+
+
+# Роли процесса:
+#   all       — бот, сайт и планировщик в одном event loop (как раньше)
+#   bot       — только aiogram-поллер
+#   web       — только FastAPI (/ws, /ws_chat, API)
+#   scheduler — гашение active и запись в БД
+# Раздельные роли общаются через бэкплейн-брокер:
+#   python backplane.py serve unix:///tmp/stars.sock
+#   BACKPLANE_URL=unix:///tmp/stars.sock python main.py --role bot
+#   BACKPLANE_URL=unix:///tmp/stars.sock CHAT_SESSION_SECRET=... python main.py --role web
+#   BACKPLANE_URL=unix:///tmp/stars.sock python main.py --role scheduler
+#
+# Вместо python main.py --role web можно несколько воркеров uvicorn
+# (под uvicorn роль по умолчанию — web):
+#   BACKPLANE_URL=unix:///tmp/stars.sock CHAT_SESSION_SECRET=... uvicorn main:app --workers 4
+# (бот и планировщик тогда — отдельными процессами, как выше)
+ROLES = ("all", "bot", "web", "scheduler")
+
+# фоновые задачи процесса; None — ещё не запущены
+process_tasks: Optional[List[asyncio.Task]] = None
+
+
+def role_error(role: str) -> Optional[str]:
+    if role not in ROLES:
+        return f"Unknown role {role!r}, expected one of {', '.join(ROLES)}"
+    # сайт и в одиночку работает на памяти процесса (uvicorn main:app без
+    # BACKPLANE_URL — один воркер); боту и планировщику без общей шины не с кем говорить
+    if role in ("bot", "scheduler") and not backplane.shared:
+        return (
+            f"Role {role!r} needs a shared backplane: start `python backplane.py serve` "
+            "and set BACKPLANE_URL (e.g. unix:///tmp/stars.sock)"
+        )
+    if (
+        role in ("all", "bot") and BOT_MODE == "webhook"
+        and not WEBHOOK_SECRET_SET and not WEBHOOK_BASE_URL
+    ):
+        return (
+            "Webhook mode needs WEBHOOK_SECRET (the one the webhook was registered with) "
+            "or WEBHOOK_BASE_URL to register it with a generated secret"
+        )
+    if role in ("all", "web") and backplane.shared and not CHAT_SESSION_SECRET_SET:
+        return (
+            "Set CHAT_SESSION_SECRET to the same random value for every web process, "
+            "e.g. python -c 'import secrets; print(secrets.token_hex(32))'"
+        )
+    return None
+
+
+# Запросы к звёздам и чату читают колонки из последних миграций: на старой схеме
+# всё падает с Unknown column. DB_AUTO_MIGRATE=1 — применить ожидающие миграции
+# при старте, иначе процесс не стартует, пока не выполнят python db.py migrate.
+DB_AUTO_MIGRATE = os.environ.get("DB_AUTO_MIGRATE", "0") == "1"
+
+
+async def check_schema():
+    try:
+        pending = await db_async.pending_migrations()
+    except Exception as e:
+        # БД недоступна — проверим нечем, как и прогрев кэша, стартуем без неё
+        print("DEBUG schema check failed:", e)
+        return
+    if not pending:
+        return
+    if DB_AUTO_MIGRATE:
+        await db_async.migrate()
+        return
+    raise RuntimeError(
+        f"Database schema is out of date, pending migrations: {pending}. "
+        "Run `python db.py migrate` or set DB_AUTO_MIGRATE=1"
+    )
+
+
+async def start_process(role: str) -> List[asyncio.Task]:
+    # всё, что нужно роли, кроме самого HTTP-сервера
+    global mirror_remote_stars, process_tasks
+
+    await check_schema()
+
+    mirror_remote_stars = role == "scheduler"
+    await backplane.start()
+
+    if role in ("all", "web") and USER_CACHE_WARMUP:
+        try:
+            await warmup_user_cache()
+        except Exception as e:
+            print("User cache warmup failed:", e)
+
+    # write-behind нужен каждому процессу, который меняет звёзды
+    tasks = [asyncio.create_task(star_flush_loop())]
+
+    if role in ("all", "bot"):
+        tasks.append(asyncio.create_task(run_bot()))
+
+    if role in ("all", "web"):
+        tasks.append(asyncio.create_task(chat_journal.run()))
+
+    if role in ("all", "scheduler"):
+        tasks.append(asyncio.create_task(active_flag_loop()))
+    else:
+        tasks.append(asyncio.create_task(cache_maintenance_loop()))
+
+    if STATS_LOG_INTERVAL > 0:
+        tasks.append(asyncio.create_task(stats_log_loop()))
+
+    process_tasks = tasks
+    return tasks
+
+
+async def flush_pending():
+    # сбрасываем всё, что ещё не дошло до БД
+    await flush_star_states()
+    await chat_journal.flush()
+
+
+async def stop_process(tasks: List[asyncio.Task]):
+    global process_tasks
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    process_tasks = None
+
+    await flush_pending()
+    await backplane.close()
+    db_async.shutdown()
+
+
+async def serve_http(asgi_app: FastAPI):
     port = int(os.environ.get("PORT", "8000"))
-    config = uvicorn.Config(app, host="0.0.0.0", port=port, reload=False)
+    config = uvicorn.Config(asgi_app, host="0.0.0.0", port=port, reload=False)
     server = uvicorn.Server(config)
-    api_task = asyncio.create_task(server.serve())
+    await server.serve()
+
+
+async def main(role: str = "all"):
+    error = role_error(role)
+    if error:
+        print(error)
+        return
 
-    decay_task = asyncio.create_task(activity_decay_loop())
+    try:
+        tasks = await start_process(role)
+    except RuntimeError as e:
+        print(e)
+        return
+    servers = []
+
+    if role in ("all", "web"):
+        servers.append(asyncio.create_task(serve_http(app)))
+    elif role == "bot" and BOT_MODE == "webhook":
+        # отдельному процессу бота нужен свой HTTP только под webhook
+        bot_app = FastAPI()
+        bot_app.include_router(webhook_router)
+        servers.append(asyncio.create_task(serve_http(bot_app)))
+
+    runner = asyncio.gather(*tasks, *servers)
+    if not servers:
+        # Без uvicorn сигналы ловим сами: иначе SIGTERM (его шлют Render и
+        # контейнеры) убивает процесс раньше финального сброса в stop_process().
+        # Под uvicorn так нельзя — он ставит свои обработчики, а сброс делает lifespan.
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, runner.cancel)
 
-    await asyncio.gather(bot_task, api_task, decay_task)
+    try:
+        await runner
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for task in servers:
+            task.cancel()
+        await stop_process(tasks)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Starsky: бот, сайт и планировщик")
+    parser.add_argument(
+        "--role",
+        choices=ROLES,
+        default=os.environ.get("ROLE", "all"),
+        help="какую часть запускать в этом процессе",
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.role))
+    except KeyboardInterrupt:
+        # Ctrl+C под uvicorn: main() уже всё остановил и сбросил
+        pass
\ No newline at end of file
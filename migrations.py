@@ -0,0 +1,195 @@
+from typing import Callable, List, Optional, Tuple, Union
+
+from mysql.connector import Error
+
+from db import get_connection
+
+
+# ====== МИГРАЦИИ СХЕМЫ ======
+# Версии применяются по порядку и записываются в schema_migrations.
+# DDL в MySQL коммитится сразу, поэтому каждый шаг написан так, чтобы его
+# можно было безопасно повторить (IF NOT EXISTS, проверка индексов):
+# упавшая на середине миграция просто перезапускается.
+#
+#   python db.py migrate   — применить всё, что не применено
+#   python db.py status    — показать применённые и ожидающие версии
+
+Step = Union[str, Callable]
+
+
+def _index_exists(cur, table: str, name: str) -> bool:
+    cur.execute(
+        """
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+        """,
+        (table, name)
+    )
+    return cur.fetchone() is not None
+
+
+def _column_type(cur, table: str, column: str) -> Optional[str]:
+    cur.execute(
+        """
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """,
+        (table, column)
+    )
+    row = cur.fetchone()
+    return row[0].lower() if row else None
+
+
+def add_index(table: str, name: str, columns: str, unique: bool = False) -> Callable:
+    def step(cur):
+        if _index_exists(cur, table, name):
+            return
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        cur.execute(f"ALTER TABLE {table} ADD {kind} {name} ({columns})")
+    return step
+
+
+def add_column(table: str, column: str, definition: str) -> Callable:
+    def step(cur):
+        if _column_type(cur, table, column) is not None:
+            return
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+def _skins_owned_to_json(cur):
+    # Раньше skins_owned жил в TEXT как JSON-строка (или пустой/NULL).
+    # Чиним мусор и переводим колонку в нативный JSON: MySQL сам проверяет
+    # формат, а JSON_CONTAINS работает без разбора строки в Python.
+    if _column_type(cur, "user_stars", "skins_owned") == "json":
+        return
+    cur.execute(
+        """
+        UPDATE user_stars SET skins_owned = '[]'
+        WHERE skins_owned IS NULL OR skins_owned = '' OR NOT JSON_VALID(skins_owned)
+        """
+    )
+    cur.execute("ALTER TABLE user_stars MODIFY skins_owned JSON NOT NULL")
+
+
+MIGRATIONS: List[Tuple[int, str, List[Step]]] = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id   BIGINT       NOT NULL PRIMARY KEY,
+            username      VARCHAR(64)  NULL,
+            info          TEXT         NULL,
+            last_activity DATETIME     NULL,
+            login_code    VARCHAR(16)  NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id         BIGINT       NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            user_id    BIGINT       NOT NULL,
+            username   VARCHAR(64)  NULL,
+            text       TEXT         NOT NULL,
+            created_at DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_stars (
+            user_id        BIGINT       NOT NULL PRIMARY KEY,
+            activity_score DOUBLE       NOT NULL DEFAULT 0,
+            star_color     VARCHAR(16)  NOT NULL DEFAULT '#ffffff',
+            star_shape     VARCHAR(32)  NOT NULL DEFAULT 'circle',
+            info           TEXT         NULL,
+            skins_owned    TEXT         NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """,
+        # таблицы, созданные руками до миграций, могли остаться без login_code
+        add_column("users", "login_code", "VARCHAR(16) NULL"),
+    ]),
+    (2, "lookup indexes", [
+        # прогрев кэша: ORDER BY last_activity DESC LIMIT N
+        add_index("users", "idx_users_last_activity", "last_activity"),
+        # история чата по времени; сама keyset-пагинация идёт по первичному ключу id
+        add_index("chat_messages", "idx_chat_messages_created_id", "created_at, id"),
+    ]),
+    (3, "skins_owned as JSON", [
+        _skins_owned_to_json,
+    ]),
+    (4, "activity timestamp", [
+        # unix-время, на которое записан activity_score: текущие очки считаются
+        # при чтении, и затухание больше не переписывает строки. NULL — старые
+        # строки, их очки считаются снятыми в момент загрузки
+        add_column("user_stars", "activity_at", "DOUBLE NULL AFTER activity_score"),
+    ]),
+    (5, "chat message write batch", [
+        # метка пачки журнала чата: по ней save_public_messages узнаёт id строк
+        # своего multi-row INSERT
+        add_column("chat_messages", "write_batch", "CHAR(16) NULL"),
+    ]),
+]
+
+
+def _ensure_migrations_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version    INT          NOT NULL PRIMARY KEY,
+            name       VARCHAR(128) NOT NULL,
+            applied_at DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+
+
+def applied_versions(cur) -> List[int]:
+    _ensure_migrations_table(cur)
+    cur.execute("SELECT version FROM schema_migrations ORDER BY version")
+    return [row[0] for row in cur.fetchall()]
+
+
+def migrate(target: Optional[int] = None) -> List[int]:
+    # Применяет ожидающие миграции (до target включительно), возвращает их версии.
+    # GET_LOCK не даёт двум воркерам мигрировать одновременно.
+    conn = get_connection()
+    cur = conn.cursor()
+    done = []
+    try:
+        cur.execute("SELECT GET_LOCK('starsky_schema_migrations', 60)")
+        if cur.fetchone()[0] != 1:
+            raise Error(msg="could not acquire schema migration lock")
+        try:
+            applied = set(applied_versions(cur))
+            for version, name, steps in MIGRATIONS:
+                if version in applied or (target is not None and version > target):
+                    continue
+                print(f"Applying migration {version}: {name}")
+                for step in steps:
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name)
+                )
+                conn.commit()
+                done.append(version)
+        finally:
+            cur.execute("SELECT RELEASE_LOCK('starsky_schema_migrations')")
+            cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+    return done
+
+
+def status() -> List[Tuple[int, str, bool]]:
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        applied = set(applied_versions(cur))
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+    return [(version, name, version in applied) for version, name, _ in MIGRATIONS]
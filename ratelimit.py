@@ -0,0 +1,69 @@
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+
+# ====== Ограничение частоты действий ======
+# Token bucket на ключ (id пользователя, соединение): в ведре до burst жетонов,
+# они пополняются со скоростью rate в секунду, каждое действие тратит cost.
+# Ведро — пара (жетоны, время последнего обращения), проверка O(1).
+# Ведро, простоявшее burst / rate секунд, снова полное и ничем не отличается
+# от отсутствующего, поэтому такие ключи выкидываются раз в SWEEP_EVERY проверок.
+#
+# Лимит в настройках пишется как "N/S" — N действий за S секунд подряд,
+# дальше в среднем N/S в секунду. "0" или "off" — без ограничения.
+
+
+class RateLimiter:
+    SWEEP_EVERY = 4096
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.enabled = rate > 0 and burst > 0
+        self._idle = burst / rate if self.enabled else 0.0
+        self._buckets: Dict[Hashable, Tuple[float, float]] = {}
+        self._checks = 0
+
+    @classmethod
+    def from_spec(cls, spec: str) -> "RateLimiter":
+        spec = (spec or "").strip().lower()
+        if spec in ("", "0", "off"):
+            return cls(0.0, 0.0)
+        count, _, seconds = spec.partition("/")
+        count = float(count)
+        seconds = float(seconds or 1)
+        return cls(count / seconds, count)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, key: Hashable, cost: float = 1.0, now: Optional[float] = None) -> bool:
+        if not self.enabled:
+            return True
+        now = time.monotonic() if now is None else now
+
+        self._checks += 1
+        if self._checks % self.SWEEP_EVERY == 0:
+            self.sweep(now)
+
+        state = self._buckets.get(key)
+        if state is None:
+            tokens = self.burst
+        else:
+            tokens, stamp = state
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - cost, now)
+        return True
+
+    def forget(self, key: Hashable):
+        self._buckets.pop(key, None)
+
+    def sweep(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        idle = [key for key, (_, stamp) in self._buckets.items() if now - stamp >= self._idle]
+        for key in idle:
+            del self._buckets[key]
@@ -0,0 +1,144 @@
+import math
+import os
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+
+# ====== КООРДИНАТЫ И ТАЙЛЫ НЕБА ======
+# Небо — квадрат [0, 1) x [0, 1), разбитый на SKY_TILES x SKY_TILES тайлов.
+# Координаты звезды — хэш её id: одинаковые на всех узлах и после рестарта,
+# хранить их не нужно. Звезда никогда не переезжает в другой тайл.
+# Тайл записывается строкой "tx:ty".
+
+SKY_TILES = int(os.environ.get("SKY_TILES", "16"))
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(value: int) -> int:
+    # splitmix64: соседние id разлетаются по всему небу
+    z = (value + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+def star_position(user_id: int) -> Tuple[float, float]:
+    h = _mix64(user_id & _MASK64)
+    return round((h >> 32) / 2 ** 32, 6), round((h & 0xFFFFFFFF) / 2 ** 32, 6)
+
+
+def _cell(coord: float) -> int:
+    # прижимаем к небу до int(): координаты из запроса бывают любыми
+    return min(SKY_TILES - 1, int(min(max(coord, 0.0), 1.0) * SKY_TILES))
+
+
+def tile_of(x: float, y: float) -> str:
+    return f"{_cell(x)}:{_cell(y)}"
+
+
+def star_tile(user_id: int) -> str:
+    return tile_of(*star_position(user_id))
+
+
+def parse_tiles(raw) -> Optional[Set[str]]:
+    # "3:5,4:5" или ["3:5", "4:5"]; None — список кривой
+    if isinstance(raw, str):
+        raw = [part for part in raw.split(",") if part.strip()]
+    if not isinstance(raw, list) or not raw or len(raw) > SKY_TILES * SKY_TILES:
+        return None
+    tiles = set()
+    for item in raw:
+        tx, sep, ty = str(item).strip().partition(":")
+        try:
+            tx, ty = int(tx), int(ty)
+        except ValueError:
+            return None
+        if not sep or not (0 <= tx < SKY_TILES and 0 <= ty < SKY_TILES):
+            return None
+        tiles.add(f"{tx}:{ty}")
+    return tiles
+
+
+def parse_rect(raw) -> Optional[Set[str]]:
+    # "x0,y0,x1,y1" или [x0, y0, x1, y1] в координатах неба -> тайлы прямоугольника
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    if not isinstance(raw, list) or len(raw) != 4:
+        return None
+    try:
+        x0, y0, x1, y1 = (float(v) for v in raw)
+    except (TypeError, ValueError):
+        return None
+    if not all(math.isfinite(v) for v in (x0, y0, x1, y1)) or x1 < x0 or y1 < y0:
+        return None
+    return {
+        f"{tx}:{ty}"
+        for tx in range(_cell(x0), _cell(x1) + 1)
+        for ty in range(_cell(y0), _cell(y1) + 1)
+    }
+
+
+def is_whole_sky(tiles: Set[str]) -> bool:
+    return len(tiles) >= SKY_TILES * SKY_TILES
+
+
+class TileIndex:
+    # тайл -> id звёзд в нём
+    def __init__(self):
+        self.tiles: Dict[str, Set[int]] = {}
+
+    def add(self, user_id: int) -> str:
+        tile = star_tile(user_id)
+        self.tiles.setdefault(tile, set()).add(user_id)
+        return tile
+
+    def ids_in(self, tiles: Iterable[str]) -> Set[int]:
+        result: Set[int] = set()
+        for tile in tiles:
+            result.update(self.tiles.get(tile, ()))
+        return result
+
+
+class TileSubscriptions:
+    # Кто какие тайлы смотрит. Соединение без окна просмотра получает всё небо.
+    # Два индекса, как у чата: тайл -> соединения и соединение -> его тайлы.
+
+    def __init__(self):
+        self.whole_sky: Set[Hashable] = set()
+        self.by_tile: Dict[str, Set[Hashable]] = {}
+        self.conn_tiles: Dict[Hashable, Set[str]] = {}
+
+    def add(self, conn: Hashable):
+        self.whole_sky.add(conn)
+
+    def remove(self, conn: Hashable):
+        self.whole_sky.discard(conn)
+        for tile in self.conn_tiles.pop(conn, ()):
+            subs = self.by_tile.get(tile)
+            if subs is not None:
+                subs.discard(conn)
+                if not subs:
+                    del self.by_tile[tile]
+
+    def set_view(self, conn: Hashable, tiles: Optional[Set[str]]):
+        # tiles None (или всё небо) — снова получать все звёзды
+        self.remove(conn)
+        if tiles is None or is_whole_sky(tiles):
+            self.whole_sky.add(conn)
+            return
+        self.conn_tiles[conn] = set(tiles)
+        for tile in tiles:
+            self.by_tile.setdefault(tile, set()).add(conn)
+
+    def view_of(self, conn: Hashable) -> Optional[Set[str]]:
+        return self.conn_tiles.get(conn)
+
+    def group_by_conn(self, stars: List[Dict]) -> Dict[Hashable, List[Dict]]:
+        # звёзды пачки по соединениям с окном просмотра: каждому — из всех его тайлов
+        groups: Dict[Hashable, List[Dict]] = {}
+        if not self.by_tile:
+            return groups
+        for star in stars:
+            for conn in self.by_tile.get(star_tile(star["id"]), ()):
+                groups.setdefault(conn, []).append(star)
+        return groups
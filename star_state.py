@@ -0,0 +1,399 @@
+import itertools
+import json
+import secrets
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+from sky_tiles import TileIndex, star_tile
+
+
+# ====== РЕЙТИНГ ЗВЁЗД ======
+
+class Leaderboard:
+    # Звёзды по убыванию очков (при равенстве — по id) в SortedList:
+    # обновление, место звезды и первые k — за O(log n), без сортировки всего неба.
+    #
+    # Очки затухают со временем, поэтому ключ — не сами очки, а
+    # key = score + rate * at: текущие очки равны max(key - rate * now, 0),
+    # все звёзды затухают одинаково, и порядок ключей от времени не зависит.
+
+    def __init__(self, decay_per_sec: float = 0.0):
+        self.rate = decay_per_sec
+        self._order = SortedList()
+        self._scores: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def update(self, star_id: int, score: float, at: Optional[float] = None):
+        key = float(score or 0) + self.rate * (at or 0.0)
+        old = self._scores.get(star_id)
+        if old == key:
+            return
+        if old is not None:
+            self._order.remove((-old, star_id))
+        self._scores[star_id] = key
+        self._order.add((-key, star_id))
+
+    def score(self, star_id: int, now: Optional[float] = None) -> float:
+        key = self._scores.get(star_id)
+        if key is None:
+            return 0.0
+        now = time.time() if now is None else now
+        return max(key - self.rate * now, 0.0)
+
+    def top(self, k: int) -> List[int]:
+        return [star_id for _, star_id in self._order.islice(0, k)]
+
+    def rank(self, star_id: int) -> Optional[int]:
+        # место с единицы, None — звезды нет
+        score = self._scores.get(star_id)
+        if score is None:
+            return None
+        return self._order.bisect_left((-score, star_id)) + 1
+
+
+# ====== СНАПШОТ НЕБА ДЛЯ /api/stars ======
+
+class StarsSnapshot:
+    # Общий для всех клиентов список звёзд: обновляется теми же событиями,
+    # что уходят в /ws, а JSON-тело и ETag пересчитываются только после изменений.
+    #
+    # Каждое изменение получает монотонный номер seq; звёзды хранятся в порядке
+    # последнего изменения, поэтому «что поменялось после seq N» — это хвост словаря.
+    # Индекс тайлов отвечает на «какие звёзды в этом куске неба» без обхода всех,
+    # рейтинг — на «самые яркие звёзды» и «какое место у звезды».
+
+    def __init__(self, decay_per_sec: float = 0.0):
+        self.stars: "OrderedDict[int, Dict]" = OrderedDict()
+        self.loaded = False
+        self.seq = 0
+        # seq начинается заново после рестарта процесса — клиенты сверяют epoch
+        self.epoch = secrets.token_hex(4)
+        self._star_seq: Dict[int, int] = {}
+        self.tiles = TileIndex()
+        self.leaders = Leaderboard(decay_per_sec)
+        self._body: Optional[bytes] = None
+        self._etag: Optional[str] = None
+
+    def load(self, stars: List[Dict]):
+        # Данные из БД старше событий, пришедших, пока шёл запрос, — их не затираем
+        self.seq += 1
+        for star in stars:
+            if star["id"] not in self.stars:
+                self.stars[star["id"]] = star
+                self._star_seq[star["id"]] = self.seq
+                self.tiles.add(star["id"])
+                self.leaders.update(star["id"], star.get("activity_score"), star.get("activity_at"))
+        self.loaded = True
+        self._invalidate()
+
+    def update(self, star: Dict) -> bool:
+        star_id = star["id"]
+        if self.stars.get(star_id) == star:
+            return False
+        self.seq += 1
+        if star_id not in self.stars:
+            self.tiles.add(star_id)
+        self.stars[star_id] = star
+        self.stars.move_to_end(star_id)
+        self._star_seq[star_id] = self.seq
+        self.leaders.update(star_id, star.get("activity_score"), star.get("activity_at"))
+        self._invalidate()
+        return True
+
+    def changes_since(self, since: int) -> List[Dict]:
+        result = []
+        for star_id in reversed(self.stars):
+            if self._star_seq[star_id] <= since:
+                break
+            result.append(self.stars[star_id])
+        result.reverse()
+        return result
+
+    def in_tiles(self, tiles: Iterable[str], since: int = 0) -> List[Dict]:
+        tiles = set(tiles)
+        if since > 0:
+            return [s for s in self.changes_since(since) if star_tile(s["id"]) in tiles]
+        stars = self.stars
+        return [stars[star_id] for star_id in self.tiles.ids_in(tiles) if star_id in stars]
+
+    def _invalidate(self):
+        self._body = None
+        self._etag = None
+
+    def render(self) -> Tuple[bytes, str]:
+        if self._body is None:
+            self._body = json.dumps(
+                list(self.stars.values()), ensure_ascii=False
+            ).encode("utf-8")
+            self._etag = f'"{self.epoch}-{self.seq}"'
+        return self._body, self._etag
+
+
+# ====== ЗАПИСЬ ПОЛЬЗОВАТЕЛЯ В КЭШЕ ======
+
+DEFAULT_STAR_COLOR = "#ffffff"
+DEFAULT_STAR_SHAPE = "circle"
+
+
+class StarUser:
+    # Компактная запись пользователя в кэше users. Очки активности сюда не входят —
+    # они лежат в ActivityScores. last_active — time.monotonic() последней активности
+    # (0.0 — ещё не был активен), чтобы is_active не разбирал ISO-строку на каждый вызов.
+    # Цвета и формы интернируются: на всё небо остаётся по одной строке на значение.
+
+    __slots__ = ("id", "username", "full_name", "info", "skins_owned", "last_active", "_color", "_shape")
+
+    def __init__(
+        self,
+        user_id: int,
+        username: str,
+        full_name: Optional[str] = None,
+        star_color: Optional[str] = None,
+        star_shape: Optional[str] = None,
+        info: str = "",
+        skins_owned: Optional[List[str]] = None,
+    ):
+        self.id = user_id
+        self.username = username
+        self.full_name = full_name or username
+        self.star_color = star_color
+        self.star_shape = star_shape
+        self.info = info or ""
+        self.skins_owned = list(skins_owned or [])
+        self.last_active = 0.0
+
+    @property
+    def star_color(self) -> str:
+        return self._color
+
+    @star_color.setter
+    def star_color(self, value: Optional[str]):
+        self._color = sys.intern(value or DEFAULT_STAR_COLOR)
+
+    @property
+    def star_shape(self) -> str:
+        return self._shape
+
+    @star_shape.setter
+    def star_shape(self, value: Optional[str]):
+        self._shape = sys.intern(value or DEFAULT_STAR_SHAPE)
+
+
+# ====== КЭШ ПОЛЬЗОВАТЕЛЕЙ ======
+
+class StarUserCache:
+    # Ограниченный кэш StarUser: LRU-порядок, вытеснение давно не трогавших кэш
+    # (ttl) и отрицательный кэш для id, которых нет в БД.
+    #
+    # can_evict(user) решает, можно ли выгнать запись (активные звёзды не трогаем),
+    # on_evict(user) вызывается до удаления — чтобы сохранить несброшенные изменения.
+
+    # сколько записей с «холодного» конца смотреть в поисках кандидата на вытеснение
+    EVICT_SCAN = 32
+
+    def __init__(
+        self,
+        capacity: int,
+        ttl: float,
+        negative_ttl: float,
+        can_evict: Optional[Callable[[StarUser], bool]] = None,
+        on_evict: Optional[Callable[[StarUser], None]] = None,
+        negative_capacity: Optional[int] = None,
+    ):
+        self.capacity = max(capacity, 1)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # отрицательный кэш ограничен отдельно: перебор несуществующих id не должен его раздувать
+        self.negative_capacity = max(negative_capacity or capacity, 1)
+        self.can_evict = can_evict
+        self.on_evict = on_evict
+
+        self._items: "OrderedDict[int, StarUser]" = OrderedDict()
+        self._used_at: Dict[int, float] = {}
+        # id -> когда забыть; ttl у всех один, поэтому порядок вставки — порядок истечения
+        self._missing: "OrderedDict[int, float]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, user_id: int) -> StarUser:
+        user = self.get(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def __setitem__(self, user_id: int, user: StarUser):
+        self.put(user_id, user)
+
+    def put(self, user_id: int, user: StarUser, cold: bool = False):
+        # cold=True кладёт запись в «холодный» конец — для прогрева, где строки
+        # идут от самых недавних к самым старым
+        self._items[user_id] = user
+        self._items.move_to_end(user_id, last=not cold)
+        self._used_at[user_id] = time.monotonic()
+        self._missing.pop(user_id, None)
+        if len(self._items) > self.capacity:
+            self._evict_lru()
+
+    def get(self, user_id: int, default=None) -> Optional[StarUser]:
+        user = self._items.get(user_id)
+        if user is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(user_id)
+        self._used_at[user_id] = time.monotonic()
+        return user
+
+    def peek(self, user_id: int) -> Optional[StarUser]:
+        # без влияния на LRU и счётчики — для фоновых задач
+        return self._items.get(user_id)
+
+    def values(self) -> Iterator[StarUser]:
+        return iter(list(self._items.values()))
+
+    def mark_missing(self, user_id: int):
+        self._missing.pop(user_id, None)
+        self._missing[user_id] = time.monotonic() + self.negative_ttl
+        if len(self._missing) > self.negative_capacity:
+            self._missing.popitem(last=False)
+
+    def is_missing(self, user_id: int) -> bool:
+        expires = self._missing.get(user_id)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._missing[user_id]
+            return False
+        self.negative_hits += 1
+        return True
+
+    def _remove(self, user_id: int):
+        user = self._items[user_id]
+        if self.on_evict:
+            self.on_evict(user)
+        del self._items[user_id]
+        self._used_at.pop(user_id, None)
+        self.evictions += 1
+
+    def _evict_lru(self):
+        # смотрим только EVICT_SCAN записей с холодного конца, без копии всего кэша
+        for user_id, user in itertools.islice(self._items.items(), self.EVICT_SCAN):
+            if self.can_evict is None or self.can_evict(user):
+                break
+        else:
+            # все кандидаты сейчас активны — временно живём чуть сверх capacity
+            return
+        self._remove(user_id)
+
+    def expire(self):
+        # Выгоняет записи, к которым не обращались дольше ttl, и протухший отрицательный кэш
+        now = time.monotonic()
+        for user_id in list(self._items):
+            if now - self._used_at[user_id] <= self.ttl:
+                break
+            if self.can_evict is None or self.can_evict(self._items[user_id]):
+                self._remove(user_id)
+        while self._missing:
+            user_id, expires = next(iter(self._missing.items()))
+            if expires >= now:
+                break
+            del self._missing[user_id]
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._items),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "negative_size": len(self._missing),
+            "evictions": self.evictions,
+        }
+
+
+# ====== ОЧКИ АКТИВНОСТИ ======
+
+class ActivityScores:
+    # Очки активности в двух колонках array('d') (8 байт на значение вместо float-объекта
+    # в словаре пользователя); индекс в колонке — слот пользователя.
+    #
+    # Затухание ленивое: храним очки на момент последнего изменения и время изменения,
+    # текущее значение считается при чтении:  max(base - rate * (now - touched), 0).
+    # Время — unix (time.time()): пара (base, touched) так же лежит в БД и уходит
+    # клиентам, и простаивающую звезду никто не переписывает.
+
+    def __init__(self, decay_per_sec: float):
+        self.rate = decay_per_sec
+        self._base = array("d")
+        self._touched = array("d")
+        self._slots: Dict[int, int] = {}
+        self._free: List[int] = []
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._slots
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _slot(self, user_id: int) -> int:
+        slot = self._slots.get(user_id)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._base)
+                self._base.append(0.0)
+                self._touched.append(0.0)
+            self._slots[user_id] = slot
+        return slot
+
+    def _value(self, slot: int, now: float) -> float:
+        return max(self._base[slot] - self.rate * (now - self._touched[slot]), 0.0)
+
+    def get(self, user_id: int, now: Optional[float] = None) -> float:
+        slot = self._slots.get(user_id)
+        if slot is None:
+            return 0.0
+        return self._value(slot, time.time() if now is None else now)
+
+    def state(self, user_id: int) -> Tuple[float, float]:
+        # (очки, когда они были такими) — то, что пишется в БД и уходит клиентам
+        slot = self._slots.get(user_id)
+        if slot is None:
+            return 0.0, 0.0
+        return self._base[slot], self._touched[slot]
+
+    def set(self, user_id: int, score: float, at: Optional[float] = None) -> float:
+        # at — когда у звезды было score очков (из БД или с другого узла), по умолчанию сейчас
+        slot = self._slot(user_id)
+        score = max(float(score), 0.0)
+        self._base[slot] = score
+        self._touched[slot] = time.time() if at is None else at
+        return score
+
+    def add(self, user_id: int, amount: float, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        return self.set(user_id, self.get(user_id, now) + amount, now)
+
+    def release(self, user_id: int):
+        slot = self._slots.pop(user_id, None)
+        if slot is not None:
+            self._base[slot] = 0.0
+            self._touched[slot] = 0.0
+            self._free.append(slot)
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+from collections import deque
+from typing import Awaitable, Callable, Iterable, Optional
+
+from fastapi import WebSocket
+
+
+# сколько секунд ждём один send, прежде чем признать клиента «медленным» и отключить
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", "5"))
+# сколько сообщений может ждать отправки одному клиенту
+WS_QUEUE_SIZE = int(os.environ.get("WS_QUEUE_SIZE", "256"))
+# типы сообщений, которые при переполнении очереди можно выбросить (старые — первыми);
+# всё остальное (private, public, system...) не теряется: не влезло — клиент отключается
+WS_DROPPABLE_TYPES = set(
+    t.strip() for t in os.environ.get("WS_DROPPABLE_TYPES", "activity_update,activity_batch").split(",") if t.strip()
+)
+
+
+def encode_json(data: dict) -> str:
+    # тот же формат, что у WebSocket.send_json, но сериализуем один раз на всех получателей
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def is_droppable(data: dict) -> bool:
+    return data.get("type") in WS_DROPPABLE_TYPES
+
+
+class ClientConnection:
+    # Сокет клиента со своей очередью исходящих сообщений и задачей-писателем.
+    # Отправка только кладёт текст в очередь и никогда не ждёт клиента;
+    # медленный клиент теряет устаревшие activity_update или отключается.
+
+    def __init__(
+        self,
+        ws: WebSocket,
+        on_close: Optional[Callable[["ClientConnection"], None]] = None,
+        max_queue: int = WS_QUEUE_SIZE,
+        send_timeout: float = WS_SEND_TIMEOUT,
+    ):
+        self.ws = ws
+        self.on_close = on_close
+        self.max_queue = max(max_queue, 1)
+        self.send_timeout = send_timeout
+
+        self.closed = False
+        self.dropped = 0
+        self._queue = deque()  # (text, droppable)
+        self._wakeup = asyncio.Event()
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def send(self, text: str, droppable: bool = False) -> bool:
+        if self.closed:
+            return False
+
+        if len(self._queue) >= self.max_queue and not self._drop_oldest():
+            if droppable:
+                self.dropped += 1
+                return False
+            # очередь забита сообщениями, которые терять нельзя — клиент не читает
+            print("DEBUG WS client queue overflow, disconnecting:", len(self._queue), "queued")
+            self.close()
+            return False
+
+        self._queue.append((text, droppable))
+        self._wakeup.set()
+        return True
+
+    async def send_json(self, data: dict) -> bool:
+        # совместимо с WebSocket.send_json, но не ждёт клиента
+        return self.send(encode_json(data), is_droppable(data))
+
+    def _drop_oldest(self) -> bool:
+        for i, (_, droppable) in enumerate(self._queue):
+            if droppable:
+                del self._queue[i]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                text, _ = self._queue.popleft()
+                await asyncio.wait_for(self.ws.send_text(text), timeout=self.send_timeout)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # сокет умер или клиент не принял сообщение за send_timeout
+            pass
+        finally:
+            self._finish()
+            try:
+                await asyncio.wait_for(self.ws.close(), timeout=1.0)
+            except Exception:
+                pass
+
+    def _finish(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        if self.on_close:
+            self.on_close(self)
+
+    def close(self):
+        self._finish()
+        # close() может прийти из on_close самого писателя — себя не отменяем
+        if not self._writer_task.done() and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+
+
+def broadcast_json(connections: Iterable[ClientConnection], data: dict):
+    # JSON один раз на всех; дальше — постановка в очереди, без ожидания клиентов
+    text = encode_json(data)
+    droppable = is_droppable(data)
+    for conn in list(connections):
+        conn.send(text, droppable)
+
+
+class Coalescer:
+    # Копит изменения по ключу и раз в window секунд отдаёт в flush
+    # только последнюю версию каждого объекта. Таймер заводится первым
+    # изменением окна, так что в тишине ничего не крутится.
+
+    def __init__(self, window: float, flush: Callable[[list], Awaitable[None]]):
+        self.window = window
+        self._flush = flush
+        self._pending: dict = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, key, item):
+        self._pending[key] = item
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        items = list(self._pending.values())
+        self._pending = {}
+        try:
+            await self._flush(items)
+        except Exception as e:
+            print("DEBUG coalescer flush error:", e)